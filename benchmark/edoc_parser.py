@@ -0,0 +1,31 @@
+'''Times parse_result against the BeautifulSoup parser on edoc pages rendered
+from the pronunciation cache, MAX_CHARS characters per page like the real
+queries
+
+    python -m benchmark.edoc_parser
+'''
+from timeit import timeit
+
+from ds.pronunciation import MAX_CHARS, parse_result, parse_result_soup
+from test.edoc import load_rows, render_html
+
+
+def main(repeat=3):
+    rows = load_rows()
+    chars = list(rows)
+    pages = [render_html(chars[i:i+MAX_CHARS], rows)
+             for i in range(0, len(chars), MAX_CHARS)]
+    assert list(map(parse_result, pages)) == list(map(parse_result_soup,
+                                                      pages))
+
+    print(f'{len(pages)} pages, {sum(map(len, pages)) >> 20} MiB')
+    times = dict()
+    for parse in (parse_result_soup, parse_result):
+        times[parse] = min(timeit(lambda: list(map(parse, pages)), number=1)
+                           for _ in range(repeat))
+        print(f'{parse.__name__:18} {times[parse]:.3f}s')
+    print(f'speedup: {times[parse_result_soup] / times[parse_result]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''Times get_province's indexed lookup, and the batch lookup of
+get_provinces (in one batch and in batches of 3), against the former scan
+of every polygon, on random coordinates inside China; needs the CHGIS
+layers in third-party/gis
+
+    python -m benchmark.gis_lookup [points]
+'''
+import random
+import sys
+from time import perf_counter
+
+import numpy as np
+from shapely.geometry import Point
+
+from ds import gis
+
+# latitude, longitude bounds of China
+Y_RANGE = (18.0, 53.5)
+X_RANGE = (73.5, 135.0)
+
+
+def random_points(n, seed=0):
+    '''`n` random points inside the provinces layer'''
+    rng = random.Random(seed)
+    reader = gis.preload()['province']
+    points = list()
+    while len(points) < n:
+        point = Point(rng.uniform(*Y_RANGE), rng.uniform(*X_RANGE))
+        if gis.find_province(reader, point) is not None:
+            points.append(point)
+    return points
+
+
+def main(n=50000):
+    start = perf_counter()
+    gis.preload()
+    print(f'loading the layers: {perf_counter() - start:.1f}s')
+    points = random_points(n)
+
+    for type, reader in gis.readers.items():
+        times = dict()
+        results = dict()
+        for find in (gis.find_province_linear, gis.find_province):
+            start = perf_counter()
+            results[find] = [find(reader, point) for point in points]
+            times[find] = perf_counter() - start
+            print(f'{type:10} {find.__name__:20} {times[find]:.2f}s')
+        linear, indexed = gis.find_province_linear, gis.find_province
+        assert results[linear] == results[indexed]
+        print(f'{type:10} speedup: {times[linear] / times[indexed]:.1f}x')
+
+        start = perf_counter()
+        found = gis.find_provinces(reader, np.array([p.x for p in points]),
+                                   np.array([p.y for p in points]))
+        batch = perf_counter() - start
+        assert [reader.provinces[i] if i >= 0 else None
+                for i in found.tolist()] == results[linear]
+        print(f'{type:10} {"find_provinces":20} {batch:.2f}s '
+              f'({times[linear] / batch:.1f}x)')
+
+        # batches of a few points, as get_person looks up
+        start = perf_counter()
+        for i in range(0, len(points), 3):
+            gis.find_provinces(reader,
+                               np.array([p.x for p in points[i:i + 3]]),
+                               np.array([p.y for p in points[i:i + 3]]))
+        small = perf_counter() - start
+        print(f'{type:10} {"by 3 points":20} {small:.2f}s '
+              f'({times[indexed] / small:.1f}x find_province)')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
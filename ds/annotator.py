@@ -4,6 +4,8 @@ from collections import Counter
 from itertools import combinations
 from operator import itemgetter
 
+from .corpus import Corpus
+
 ANNOTATED = 'gold/rhyme_judgment.json'
 CORPORA = 'gold/corpus.json'
 
@@ -76,26 +78,35 @@ def add_corpus(ids, name, description):
     save_corpora(corpora)
 
 
-def find_poems(results, ids):
-    return [poem
-            for poem in results['all']['poems']
-            if poem['id'] in set(ids)]
+def get_results_corpus(results):
+    poems = results['all']['poems']
+    if not isinstance(poems, Corpus):  # e.g. results cached as plain lists
+        poems = Corpus(poems)
+    return poems
+
+
+def find_poems(results, ids, corpus=None):
+    '''`corpus` is the get_results_corpus of the results, when looking up
+    poems many times'''
+    return (corpus or get_results_corpus(results)).select('id', ids)
 
 
 def get_non_annotated_poems(results):
     corpora = get_non_annotated_corpora()
+    poems = get_results_corpus(results)
     ret = list()
     for corpus in corpora:
         ret.append({'name': corpus['name'],
                     'description': corpus['description'],
-                    'poems': find_poems(results, corpus['ids'])})
+                    'poems': find_poems(results, corpus['ids'], poems)})
     return ret
 
 
 def score_annotator(results, annotated_poems, annotator):
     cnt = Counter()
+    corpus = get_results_corpus(results)
     for id, gold_annotated_poem in annotated_poems.items():
-        poem = find_poems(results, {id, })[0]
+        poem = find_poems(results, {id, }, corpus)[0]
         annotated_poem = annotator(poem)
         cnt[gold_annotated_poem == annotated_poem] += 1
     return cnt
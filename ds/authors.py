@@ -10,7 +10,7 @@ from pprint import pprint
 
 from tqdm import tqdm
 
-from .cbdb import get_person
+from .cbdb import get_person, locate_persons
 from .helpers import filter_constraint
 
 
@@ -68,6 +68,7 @@ def cache_authors(collection):
                    zis=get_zis(author),
                    dyn=DYNASTY.get(collection),
                    job='poet',
+                   locate=False,
                    )
               for author in authors]
 
@@ -77,7 +78,7 @@ def cache_authors(collection):
                                       total=len(kwargs))]
 
     pprint(Counter(map(len, persons)))
-    persons = list(chain.from_iterable(persons))
+    persons = locate_persons(list(chain.from_iterable(persons)))
     write_cache(persons, collection)
 
 
@@ -3,7 +3,7 @@ from contextlib import contextmanager
 from itertools import groupby
 from operator import itemgetter, methodcaller
 
-from .gis import get_province
+from .gis import get_provinces
 
 DB_FILE = 'third-party/cbdb/CBDB_20190424.db'
 LIFE_SPAN = 80  # years
@@ -138,9 +138,11 @@ def filter_by_period(dicts, time_range):
         return dicts
 
 
-# only public method
+# only public methods
 
-def get_person(name, zis=None, dyn=None, job=None):
+def get_person(name, zis=None, dyn=None, job=None, locate=True):
+    '''With locate=False, the province and prefecture are left for
+    locate_persons to fill, e.g. for many persons at once'''
     rows = query_name(name)
 
     if len(rows) > 1 and zis:
@@ -155,8 +157,18 @@ def get_person(name, zis=None, dyn=None, job=None):
 
     for p in dicts:
         p['dynasty'] = p.pop('c_dynasty_chn') or dyn
-        p['province'] = get_province(x=p['x_coord'], y=p['y_coord'])
-        p['prefecture'] = get_province(x=p['x_coord'], y=p['y_coord'],
-                                       type='prefecture')
+    if locate:
+        locate_persons(dicts)
 
     return merge(dicts)  # I am not sure anymore what this is for
+
+
+def locate_persons(persons):
+    '''Sets the province and prefecture of the persons from their
+    coordinates, in one batch'''
+    x = [p['x_coord'] for p in persons]
+    y = [p['y_coord'] for p in persons]
+    for type in ('province', 'prefecture'):
+        for p, name in zip(persons, get_provinces(x=x, y=y, type=type)):
+            p[type] = name
+    return persons
@@ -1,7 +1,11 @@
-from collections import Counter
+from collections import Counter, OrderedDict, defaultdict
 from operator import attrgetter, itemgetter
 
-from .helpers import get_average_precision, takewhile_counter_cdf
+from .helpers import (get_average_precision, get_cached_by_id,
+                      takewhile_counter_cdf)
+
+MAX_COMMUNITY_INDEXES = 8
+COMMUNITY_INDEXES = OrderedDict()  # see helpers.get_cached_by_id
 
 
 def get_community_rhyme_categories(community):
@@ -83,3 +87,28 @@ def get_top_missing(comm_a, comm_b):
 
 def community_node_to_set(community):
     return set(map(attrgetter('char'), community))
+
+
+class CommunityIndex(dict):
+    '''A dict whose `token` stands for it in the poems' caches, instead of
+    the communities themselves'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token = object()
+
+
+def build_community_index(communities):
+    '''Maps each character to the (sorted) indices of the communities it
+    belongs to'''
+    index = defaultdict(list)
+    for i, community in enumerate(communities):
+        for char in community_node_to_set(community):
+            index[char].append(i)
+    return CommunityIndex((char, tuple(ids)) for char, ids in index.items())
+
+
+def get_community_index(communities):
+    '''Builds the index of `communities` once'''
+    return get_cached_by_id(COMMUNITY_INDEXES, MAX_COMMUNITY_INDEXES,
+                            build_community_index, communities)
@@ -1,37 +1,363 @@
 import json
+import os
+import shutil
+from collections import defaultdict
+from collections.abc import Sequence
 from glob import glob
+from itertools import chain
+from multiprocessing.pool import Pool
 from operator import itemgetter
 
-from .helpers import filter_constraint
-from .poem import Poem
+import numpy as np
+
+from .helpers import (decode_range, decode_strings, encode_strings,
+                      filter_constraint, hash_file, ifilter_constraint)
+from .poem import EncodedPoems, Poem, concat_encoded, encode_poems
 
 CORPORA = {'qts': 'third-party/chinese-poetry/json/poet.tang',
            'qss': 'third-party/chinese-poetry/json/poet.song',
            'qsc': 'third-party/chinese-poetry/ci/ci.song',
            }
+SNAPSHOT_DIR = 'cache'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FIELDS = ('id', 'title', 'author')
+
+
+class Corpus(Sequence):
+    '''A list of poems, remembering which collection each poem comes from,
+    with hash indexes by id, author and collection built on first use. The
+    poems loaded from a snapshot are only built when accessed.'''
+
+    def __init__(self, poems=(), collection=None):
+        self.snapshots = list()  # (position, Snapshot) of the lazy poems
+        self.context = None
+        if isinstance(poems, Snapshot):
+            self.poems = [None] * len(poems)  # not built yet
+            self.snapshots.append((0, poems))
+        else:
+            self.poems = list(poems)
+        self.collections = [collection] * len(self.poems)
+        self.indexes = dict()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self.poems[i] is None:
+            i = range(len(self))[i]
+            start, snapshot = self.get_snapshot(i)
+            self.poems[i] = Poem(snapshot[i - start], context=self.context)
+        return self.poems[i]
+
+    def __len__(self):
+        return len(self.poems)
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self)))
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __getstate__(self):
+        return {'poems': list(self), 'collections': self.collections}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.poems = state['poems']
+        self.collections = state['collections']
+
+    def get_snapshot(self, i):
+        return next((start, snapshot)
+                    for start, snapshot in reversed(self.snapshots)
+                    if start <= i)
+
+    def set_context(self, context):
+        '''Shares the tables of `context` with all the poems, including the
+        ones built later'''
+        self.context = context
+        self.indexes.pop('rhyme_pairs', None)  # depends on the tables
+        for poem in self.poems:
+            if poem is not None:
+                poem.context = context
+
+    def append(self, poem, collection=None):
+        self.poems.append(poem)
+        self.collections.append(collection)
+        self.indexes.clear()
+
+    def extend(self, poems, collection=None):
+        if isinstance(poems, Corpus):
+            # the lazy poems are built again by this corpus
+            self.snapshots.extend((len(self.poems) + start, snapshot)
+                                  for start, snapshot in poems.snapshots)
+            self.poems.extend(poems.poems)
+            self.collections.extend(poems.collections)
+        else:
+            poems = list(poems)
+            self.poems.extend(poems)
+            self.collections.extend([collection] * len(poems))
+        self.indexes.clear()
+
+    def get_column(self, field):
+        '''The `field` of every poem, read from the snapshot arrays for the
+        poems not built yet'''
+        ret = [None if poem is None else poem.get(field)
+               for poem in self.poems]
+        for start, snapshot in self.snapshots:
+            for i, value in enumerate(snapshot.get_column(field), start):
+                if self.poems[i] is None:
+                    ret[i] = value
+        return ret
+
+    def iter_records(self):
+        '''The poems as plain dicts, without building the lazy ones'''
+        for i, poem in enumerate(self.poems):
+            if poem is None:
+                start, snapshot = self.get_snapshot(i)
+                yield snapshot[i - start]
+            else:
+                yield dict(poem)
 
+    def encode(self):
+        '''encode_poems of the corpus, taking the text of the poems of a
+        snapshot straight from its arrays'''
+        parts = list()
+        end = 0
+        for start, snapshot in self.snapshots:
+            parts.append(encode_poems(self[end:start]))
+            parts.append(snapshot.encode())
+            end = start + len(snapshot)
+        parts.append(encode_poems(self[end:]))
+        return concat_encoded(parts)
 
-def get_corpus(name):
-    def clean_line(line):
-        line = line.replace('[', '').replace(']', '')
-        return line
+    def get_index(self, field):
+        if field not in self.indexes:
+            index = defaultdict(list)
+            if field == 'collection':
+                keys = self.collections
+            else:
+                keys = self.get_column(field)
+            for i, key in enumerate(keys):
+                index[key].append(i)
+            self.indexes[field] = dict(index)
+        return self.indexes[field]
 
-    def get_poems(filename):
-        with open(filename) as f:
-            js = json.load(f)
-            for poem in js:
-                poem['paragraphs'] = [clean_line(p)
-                                      for p in poem['paragraphs']
-                                      if p and not p.startswith('（')]
-            return js
+    def select(self, field, values):
+        '''Returns the poems whose `field` is in `values`, in corpus order'''
+        index = self.get_index(field)
+        positions = sorted(chain.from_iterable(index.get(value, ())
+                                               for value in set(values)))
+        return [self[i] for i in positions]
 
-    ret = list()
+    def get_poem(self, id):
+        positions = self.get_index('id').get(id)
+        return self[positions[0]] if positions else None
+
+
+def clean_line(line):
+    line = line.replace('[', '').replace(']', '')
+    return line
+
+
+def get_poems(filename):
+    with open(filename) as f:
+        js = json.load(f)
+        for poem in js:
+            poem['paragraphs'] = [clean_line(p)
+                                  for p in poem['paragraphs']
+                                  if p and not p.startswith('（')]
+        return js
+
+
+def get_files(name):
     files = glob(f'{CORPORA[name]}.*[0-9].json')
-    for filename in sorted(files, key=lambda fn: int(fn.split('.')[-2])):
-        ret.extend(get_poems(filename))
+    return sorted(files, key=lambda fn: int(fn.split('.')[-2]))
+
+
+def iter_corpus(name, context=None):
+    '''Yields the poems of a collection one file at a time, so that only a
+    single file is ever held in memory; `context` is the PoemContext the
+    poems share'''
+    for filename in get_files(name):
+        for poem in get_poems(filename):
+            yield Poem(poem, context=context)
+
+
+def load_files(files, workers=None):
+    '''Decodes the files across a pool of `workers` processes, keeping the
+    order of `files`'''
+    if not workers or workers < 2 or len(files) < 2:
+        return list(map(get_poems, files))
+
+    with Pool(min(workers, len(files))) as p:
+        return p.map(get_poems, files)
+
+
+# Snapshots: every string column is stored as a single array of code points
+# (UTF-32) plus an offsets array, so that it can be memory-mapped
+
+
+def get_snapshot_path(name):
+    return os.path.join(SNAPSHOT_DIR, f'corpus.{name}')
+
+
+def get_signature(filename, digest=None):
+    stat = os.stat(filename)
+    return {'file': filename,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha1': digest or hash_file(filename),
+            }
+
+
+def write_manifest(path, files):
+    with open(os.path.join(path, 'manifest.json'), 'w') as g:
+        json.dump({'version': SNAPSHOT_VERSION, 'files': files}, g)
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def is_snapshot_fresh(name):
+    '''Checks the snapshot against the source files: a changed mtime only
+    invalidates the snapshot if the content hash changed too'''
+    path = get_snapshot_path(name)
+    manifest = read_manifest(path)
+    files = get_files(name)
+    if (manifest is None or manifest['version'] != SNAPSHOT_VERSION or
+            [sig['file'] for sig in manifest['files']] != files):
+        return False
+
+    touched = False
+    for sig in manifest['files']:
+        stat = os.stat(sig['file'])
+        if (stat.st_mtime_ns, stat.st_size) == (sig['mtime'], sig['size']):
+            continue
+        digest = hash_file(sig['file'])
+        if digest != sig['sha1']:
+            return False
+        sig.update(get_signature(sig['file'], digest))
+        touched = True
+
+    if touched:
+        write_manifest(path, manifest['files'])
+    return True
+
+
+def build_snapshot(name, workers=None):
+    files = get_files(name)
+    signatures = [get_signature(filename) for filename in files]
+    poems = list(chain.from_iterable(load_files(files, workers=workers)))
+
+    columns = dict()
+    for field in SNAPSHOT_FIELDS:
+        present = [isinstance(poem.get(field), str) for poem in poems]
+        columns[f'{field}.present'] = np.array(present, dtype=bool)
+        (columns[f'{field}.codes'],
+         columns[f'{field}.offsets']) = encode_strings(
+             poem[field] if p else '' for poem, p in zip(poems, present))
+
+    (columns['paragraphs.codes'],
+     columns['paragraphs.offsets']) = encode_strings(
+         chain.from_iterable(poem['paragraphs'] for poem in poems))
+    columns['paragraphs.poems'] = np.zeros(len(poems) + 1, dtype=np.int64)
+    np.cumsum([len(poem['paragraphs']) for poem in poems],
+              out=columns['paragraphs.poems'][1:])
+
+    def get_extra(poem):
+        extra = {k: v for k, v in poem.items()
+                 if k != 'paragraphs' and
+                 not (k in SNAPSHOT_FIELDS and isinstance(v, str))}
+        return json.dumps(extra, ensure_ascii=False) if extra else ''
+
+    (columns['extra.codes'],
+     columns['extra.offsets']) = encode_strings(map(get_extra, poems))
+
+    # write next to the final destination, then swap
+    path = get_snapshot_path(name)
+    tmp_path = f'{path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for column, array in columns.items():
+        np.save(os.path.join(tmp_path, f'{column}.npy'), array)
+    write_manifest(tmp_path, signatures)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+class Snapshot(Sequence):
+    '''The memory-mapped columns of a snapshot; each poem is decoded from
+    them on access, as a dict'''
+
+    def __init__(self, path):
+        self.columns = {os.path.basename(filename)[:-len('.npy')]:
+                        np.load(filename, mmap_mode='r')
+                        for filename in glob(os.path.join(path, '*.npy'))}
+
+    def __len__(self):
+        return len(self.columns['extra.offsets']) - 1
+
+    def get_strings(self, column, start, end):
+        return decode_range(self.columns[f'{column}.codes'],
+                            self.columns[f'{column}.offsets'], start, end)
+
+    def __getitem__(self, i):
+        ret = dict()
+        for field in SNAPSHOT_FIELDS:
+            if self.columns[f'{field}.present'][i]:
+                ret[field] = self.get_strings(field, i, i + 1)[0]
+        ret['paragraphs'] = self.get_strings(
+            'paragraphs', *self.columns['paragraphs.poems'][i:i + 2].tolist())
+        extra = self.get_strings('extra', i, i + 1)[0]
+        if extra:
+            ret.update(json.loads(extra))
+        return ret
+
+    def get_column(self, field):
+        if field not in SNAPSHOT_FIELDS:
+            return [poem.get(field) for poem in self]
+        values = decode_strings(self.columns[f'{field}.codes'],
+                                self.columns[f'{field}.offsets'])
+        return [value if present else None for value, present
+                in zip(values, self.columns[f'{field}.present'].tolist())]
+
+    def encode(self):
+        return EncodedPoems(self.columns['paragraphs.codes'],
+                            self.columns['paragraphs.offsets'],
+                            self.columns['paragraphs.poems'])
+
+
+def load_snapshot(name):
+    return Snapshot(get_snapshot_path(name))
+
+
+def get_snapshot(name, workers=None):
+    if not is_snapshot_fresh(name):
+        print(f'Building snapshot of corpus {name}')
+        build_snapshot(name, workers=workers)
+    return load_snapshot(name)
+
+
+def get_corpus(name, workers=None, snapshot=False):
+    '''Loads a collection; with `snapshot`, from the snapshot kept in
+    SNAPSHOT_DIR (built first if missing or stale), building the poems on
+    access'''
+    if snapshot:
+        ret = Corpus(get_snapshot(name, workers=workers), collection=name)
+    else:
+        ret = list()
+        for poems in load_files(get_files(name), workers=workers):
+            ret.extend(poems)
+        ret = Corpus(map(Poem, ret), collection=name)
 
     print(f'{len(ret)} poems in corpus {name}')
-    return list(map(Poem, ret))
+    return ret
 
 
 def filter_by_authors(authors, corpus):
@@ -42,4 +368,8 @@ def filter_by_authors(authors, corpus):
     else:
         return filter_by_authors({authors}, corpus)
 
+    if isinstance(corpus, Corpus):
+        return corpus.select('author', authors)
+    if not isinstance(corpus, Sequence):  # keep streams lazy
+        return ifilter_constraint({'author': authors.__contains__}, corpus)
     return filter_constraint({'author': authors.__contains__}, corpus)
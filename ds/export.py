@@ -0,0 +1,96 @@
+import json
+import os
+from itertools import islice
+from multiprocessing.pool import Pool
+from os import cpu_count
+
+from tqdm import tqdm
+
+from .community import build_community_index
+from .corpus import Corpus
+from .poem import Poem, PoemContext
+
+SHARD_SIZE = 1000
+
+# set once in each worker by init_worker, rather than sent with every shard
+worker = dict()
+
+
+def init_worker(prons, sbgy, communities, apply_tongyong):
+    worker['context'] = PoemContext(prons, sbgy)
+    worker['communities'] = communities
+    worker['index'] = (build_community_index(communities)
+                       if communities is not None else None)
+    worker['apply_tongyong'] = apply_tongyong
+
+
+def annotate_shard(shard):
+    ret = list()
+    for poem in shard:
+        poem = Poem(poem, context=worker['context'])
+        record = dict(poem)
+        record['category'] = poem.annotate_on_category(
+            worker['apply_tongyong'])
+        if worker['communities'] is not None:
+            record['community'] = poem.annotate(poem.groups_to_annotations(
+                poem.compute_rhyme_communities(worker['index'])))
+        ret.append(json.dumps(record, ensure_ascii=False) + '\n')
+    return ret
+
+
+def iter_records(poems):
+    '''The poems as plain dicts: the tables are sent once to each worker, not
+    with the poems, and the poems of a snapshot are not built here'''
+    if isinstance(poems, Corpus):
+        return poems.iter_records()
+    return map(dict, poems)
+
+
+def iter_shards(poems, size):
+    poems = iter_records(poems)
+    while shard := list(islice(poems, size)):
+        yield shard
+
+
+def count_exported(filename):
+    '''Counts the poems already in `filename`, dropping a last line that was
+    cut by an interruption'''
+    try:
+        with open(filename, 'rb+') as f:
+            content = f.read()
+            complete = content.rfind(b'\n') + 1
+            if complete < len(content):
+                f.truncate(complete)
+            return content.count(b'\n')
+    except FileNotFoundError:
+        return 0
+
+
+def export_annotations(poems, filename, prons, sbgy, communities=None,
+                       apply_tongyong=False, workers=None,
+                       shard_size=SHARD_SIZE):
+    '''Annotates the poems on their categories (and on `communities` if
+    given) across a pool of processes, and appends them to `filename` as
+    JSON lines in the order of `poems`. If `filename` already holds some
+    poems, e.g. after an interruption, those are skipped.'''
+    done = count_exported(filename)
+    if done:
+        print(f'Resuming after {done} poems')
+    shards = iter_shards(islice(iter_records(poems), done, None), shard_size)
+
+    with Pool(workers or max(cpu_count() - 1, 1),
+              initializer=init_worker,
+              initargs=(prons, sbgy, communities, apply_tongyong)) as p, \
+            open(filename, 'a') as g:
+        for lines in tqdm(p.imap(annotate_shard, shards)):
+            g.writelines(lines)
+            g.flush()
+            os.fsync(g.fileno())
+            done += len(lines)
+
+    return done
+
+
+def load_annotations(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f]
@@ -1,14 +1,26 @@
-import osr
+import numpy as np
 import shapefile
 from pyproj import CRS, Transformer
 from shapely.geometry import shape, Point
 from shapely.ops import transform
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+try:  # shapely >= 2: vectorized predicates
+    from shapely import contains_xy, points, prepare
+except ImportError:
+    contains_xy = points = prepare = None
 
 prov90 = 'third-party/gis/v6_citas90_prov_pgn_gbk'
 pref90 = 'third-party/gis/v6_citas90_pref_pgn_gbk'
+# from this many points on, find_provinces sweeps the bounding boxes rather
+# than querying the STRtree (measured on ~350 polygons)
+SWEEP_POINTS = 5000
 
 
 def get_transformer(prj_file):
+    import osr  # GDAL is only needed once the shapefiles are loaded
+
     prj_text = open(prj_file, 'r').read()
     srs = osr.SpatialReference()
     if srs.ImportFromWkt(prj_text):
@@ -27,18 +39,120 @@ def get_reader(db):
     return shapefile.Reader(**params, encoding=encoding)
 
 
-transformer = get_transformer(f'{prov90}.prj')
-readers = {'province': get_reader(prov90),
-           'prefecture': get_reader(pref90),
-           }
-
-for k, v in readers.items():
-    srs = readers[k].shapeRecords()
-    readers[k].provinces = list()
-    for province in srs:
+def load_reader(db, transformer):
+    reader = get_reader(db)
+    reader.provinces = list()
+    for province in reader.shapeRecords():
         gi = province.shape.__geo_interface__
         province.sh = transform(transformer.transform, shape(gi))
-        readers[k].provinces.append(province)
+        reader.provinces.append(province)
+    return index_reader(reader)
+
+
+def index_reader(reader):
+    '''Builds an STRtree over the polygons of the reader, and prepares them
+    for the exact tests'''
+    shapes = [province.sh for province in reader.provinces]
+    reader.tree = STRtree(shapes)
+    # shapely < 2 returns the geometries rather than their indexes
+    reader.ids = {id(sh): i for i, sh in enumerate(shapes)}
+    reader.prepared = list(map(prep, shapes))
+    if prepare is not None:
+        for sh in shapes:
+            prepare(sh)  # for contains_xy
+    reader.bounds = np.array([sh.bounds for sh in shapes]).reshape(-1, 4)
+    return reader
+
+
+def query_candidates(reader, point):
+    '''Indexes of the polygons whose bounding box contains `point`, in the
+    order of the shapefile'''
+    hits = reader.tree.query(point)
+    if len(hits) and hasattr(hits[0], 'geom_type'):
+        return sorted(reader.ids[id(sh)] for sh in hits)
+    return sorted(int(i) for i in hits)
+
+
+def find_province_index(reader, point):
+    '''The index of the first polygon of the reader that contains `point`,
+    like a scan of reader.provinces would find, or -1'''
+    for i in query_candidates(reader, point):
+        if reader.prepared[i].contains(point):
+            return i
+    return -1
+
+
+def find_province(reader, point):
+    i = find_province_index(reader, point)
+    if i >= 0:
+        return reader.provinces[i]
+
+
+def find_province_linear(reader, point):
+    for province in reader.provinces:
+        if point.within(province.sh):
+            return province
+
+
+def find_provinces(reader, px, py):
+    '''find_province over arrays of point coordinates, returning the indexes
+    of the polygons (-1 where none matches)'''
+    if len(px) >= SWEEP_POINTS:
+        return sweep_provinces(reader, px, py)
+    if points is None:
+        return np.array([find_province_index(reader, Point(a, b))
+                         for a, b in zip(px, py)], dtype=int)
+
+    # a single query of the STRtree for all the points; a point within
+    # several polygons keeps the first one
+    inputs, hits = reader.tree.query(points(px, py), predicate='within')
+    found = np.full(len(px), len(reader.provinces))
+    np.minimum.at(found, inputs, hits)
+    found[found == len(reader.provinces)] = -1
+    return found
+
+
+def sweep_provinces(reader, px, py):
+    '''find_provinces for large batches: the points are swept against the
+    bounding box of each polygon in turn, and only the candidates not
+    matched yet get the exact test'''
+    found = np.full(len(px), -1)
+    todo = np.ones(len(px), dtype=bool)
+    for i, (minx, miny, maxx, maxy) in enumerate(reader.bounds):
+        candidates = np.flatnonzero(todo & (minx <= px) & (px <= maxx) &
+                                    (miny <= py) & (py <= maxy))
+        if not len(candidates):
+            continue
+        if contains_xy is not None:
+            hits = contains_xy(reader.provinces[i].sh, px[candidates],
+                               py[candidates])
+        else:
+            hits = np.array([reader.prepared[i].contains(Point(a, b))
+                             for a, b in zip(px[candidates], py[candidates])],
+                            dtype=bool)
+        found[candidates[hits]] = i
+        todo[candidates[hits]] = False
+    return found
+
+
+# filled on the first call to get_province, or by preload
+readers = dict()
+
+
+def preload():
+    '''Reads the shapefiles and transforms their polygons, which is
+    otherwise done by the first call to get_province'''
+    if not readers:
+        transformer = get_transformer(f'{prov90}.prj')
+        readers.update({'province': load_reader(prov90, transformer),
+                        'prefecture': load_reader(pref90, transformer),
+                        })
+    return readers
+
+
+def get_name(province):
+    d = province.record.as_dict()
+    return get_first(d, ['NAME_HZ', 'NAME_FT', 'HZ_NAME'])
 
 
 def get_first(dic, keys):
@@ -48,14 +162,31 @@ def get_first(dic, keys):
     raise KeyError(keys)
 
 
-# only public function
+# only public functions (with preload)
 
 
 def get_province(*, y, x, type='province'):
     if not x:
         return None
-    point = Point(y, x)
-    for province in readers[type].provinces:
-        if point.within(province.sh):
-            d = province.record.as_dict()
-            return get_first(d, ['NAME_HZ', 'NAME_FT', 'HZ_NAME'])
+    province = find_province(preload()[type], Point(y, x))
+    if province is not None:
+        return get_name(province)
+
+
+def get_provinces(*, y, x, type='province'):
+    '''get_province over sequences (or arrays) of coordinates'''
+    x = np.array(x, dtype=float).reshape(-1)
+    y = np.array(y, dtype=float).reshape(-1)
+    valid = ~np.isnan(x) & (x != 0)  # what get_province skips
+    ret = [None] * len(x)
+    if not valid.any():
+        return ret
+
+    reader = preload()[type]
+    indexes = np.flatnonzero(valid)
+    for i, found in zip(indexes.tolist(),
+                        find_provinces(reader, y[indexes],
+                                       x[indexes]).tolist()):
+        if found >= 0:
+            ret[i] = get_name(reader.provinces[found])
+    return ret
@@ -3,7 +3,7 @@ import statistics
 import tempfile
 from collections import Counter, namedtuple
 from html import unescape
-from itertools import chain, compress, filterfalse, starmap
+from itertools import chain, compress, filterfalse, repeat, starmap
 from operator import itemgetter, methodcaller
 
 import matplotlib
@@ -31,14 +31,21 @@ def nx2igraph(nx_graph):
     return ret
 
 
-def build_single_poem_graph(poem, annotator):
+def build_single_poem_graph(poem, annotator, rhymes=None):
     nodes = Counter()
     edges = Counter()
-    rhymes = list(starmap(Node, zip(poem.get_rhymes(),
-                                    poem.get_rhyme_categories(apply_eq=True))))
+    if rhymes is None:
+        rhymes = poem.get_rhymes()
+        annotations = annotator(poem)
+    else:
+        with poem.given_rhymes(rhymes):  # for the annotator too
+            annotations = annotator(poem)
+    rhymes = list(starmap(Node, zip(rhymes,
+                                    poem.get_rhyme_categories(apply_eq=True,
+                                                              rhymes=rhymes))))
 
     rhyme_groups = [list(compress(rhymes, selector))
-                    for selector in annotation_to_selectors(annotator(poem))]
+                    for selector in annotation_to_selectors(annotations)]
 
     for node in rhymes:
         nodes[node] += 1
@@ -66,11 +73,14 @@ def build_single_poem_graph2(poem):
     return nodes, edges
 
 
-def build_python_graph(poems, annotator):
+def build_python_graph(poems, annotator, rhymes=None):
     nodes = Counter()
     edges = Counter()
-    for poem in tqdm(poems):
-        poem_nodes, poem_edges = build_single_poem_graph(poem, annotator)
+    if rhymes is None:
+        rhymes = repeat(None)
+    for poem, poem_rhymes in zip(tqdm(poems), rhymes):
+        poem_nodes, poem_edges = build_single_poem_graph(poem, annotator,
+                                                         poem_rhymes)
         for n, w in poem_nodes.items():
             nodes[n] += w
         for e, w in poem_edges.items():
@@ -100,8 +110,11 @@ def build_manual_graph(edge_list):
     return ret
 
 
-def build_graph(poems, annotator=methodcaller('get_naive_annotations')):
-    nodes, edges = build_python_graph(poems, annotator)
+def build_graph(poems, annotator=methodcaller('get_naive_annotations'),
+                rhymes=None):
+    '''`rhymes` optionally gives the rhyme characters of each poem, e.g. as
+    precomputed by poem.get_corpus_rhymes'''
+    nodes, edges = build_python_graph(poems, annotator, rhymes)
     return py2nx(nodes, edges)
 
 
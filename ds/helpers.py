@@ -1,15 +1,63 @@
+import hashlib
 from itertools import chain, combinations
 
+import numpy as np
+
 
 def annotation_to_selectors(annotation_list):
     return [[annotation == k for annotation in annotation_list]
             for k in set(annotation_list)]
 
 
-def filter_constraint(constraint_dict, it):
+def ifilter_constraint(constraint_dict, it):
     for k, f in constraint_dict.items():
-        it = filter(lambda a: f(a[k]), it)
-    return list(it)
+        it = filter(lambda a, k=k, f=f: f(a[k]), it)
+    return it
+
+
+def filter_constraint(constraint_dict, it):
+    return list(ifilter_constraint(constraint_dict, it))
+
+
+def hash_file(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_cached_by_id(cache, size, build, *objs):
+    '''Returns build(*objs), built once per identity of `objs` and kept in the
+    OrderedDict `cache` for the last `size` of them. Keeping `objs` alive
+    keeps their ids unique; they must not be modified in place afterwards.'''
+    key = tuple(map(id, objs))
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        cache[key] = (objs, build(*objs))
+        if len(cache) > size:
+            cache.popitem(last=False)
+    return cache[key][1]
+
+
+def encode_strings(strings):
+    strings = list(strings)
+    codes = np.frombuffer(''.join(strings).encode('utf-32-le',
+                                                  'surrogatepass'),
+                          dtype='<u4')
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum(list(map(len, strings)), out=offsets[1:])
+    return codes, offsets
+
+
+def decode_strings(codes, offsets):
+    text = codes.tobytes().decode('utf-32-le', 'surrogatepass')
+    offsets = offsets.tolist()
+    return [text[a:b] for a, b in zip(offsets, offsets[1:])]
+
+
+def decode_range(codes, offsets, start, end):
+    '''decode_strings of the strings start to end only'''
+    offsets = np.asarray(offsets[start:end + 1])
+    return decode_strings(codes[offsets[0]:offsets[-1]], offsets - offsets[0])
 
 
 def window(lst, n, pad=False):
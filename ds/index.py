@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+from collections import defaultdict, namedtuple
+from collections.abc import Sequence
+from functools import reduce
+from itertools import product
+
+import numpy as np
+
+from .corpus import (Corpus, get_snapshot_path, is_snapshot_fresh,
+                     load_snapshot)
+from .helpers import window_combinations
+from .poem import (encode_poems, get_corpus_rhymes,
+                   get_rhyme_categories_batch)
+from .pronunciation import get_rhyme_table
+
+RHYME_PAIR_INDEX = 'rhyme_pairs.json'
+NGRAM_INDEX = 'ngrams.npz'
+NgramIndex = namedtuple('NgramIndex', ['keys', 'starts', 'positions',
+                                       'line_offsets', 'poem_offsets', 'ids'])
+BIGRAM = 1 << 42  # unigram keys are code points, bigram keys are above
+
+
+def matches_snapshot(name, poems):
+    '''Whether `poems` may be the poems of the snapshot of collection `name`,
+    i.e. the snapshot is fresh and holds as many poems'''
+    return (os.path.isdir(get_snapshot_path(name)) and
+            is_snapshot_fresh(name) and len(load_snapshot(name)) == len(poems))
+
+
+# Rhyme pairs: sorted pair of GY rhymes => positions of the poems where they
+# are adjacent (the pairs Poem.find_rhyme_pairs looks for); positions rather
+# than ids, since the ci of the qsc have no id
+
+
+def build_rhyme_pair_index(poems, rhyme_categories=None):
+    if rhyme_categories is None:
+        rhymes = (get_corpus_rhymes(poems.encode())
+                  if isinstance(poems, Corpus) else None)
+        rhyme_categories = get_rhyme_categories_batch(poems, rhymes=rhymes)
+
+    index = defaultdict(set)
+    for i, gy_rhymes in enumerate(rhyme_categories):
+        for pair in set(map(tuple, map(sorted,
+                                       window_combinations(gy_rhymes, 2)))):
+            index[pair].add(i)
+    return {pair: frozenset(positions) for pair, positions in index.items()}
+
+
+def query_rhyme_pair_index(index, pair):
+    '''Returns the positions of the poems rhyming any rhyme of pair[0] with
+    any rhyme of pair[1], e.g. ('東', '冬') or ('仙先', '元')'''
+    ret = set()
+    for searched in set(map(tuple, map(sorted, product(*pair)))):
+        ret |= index.get(searched, frozenset())
+    return ret
+
+
+def get_rhyme_signature(prons):
+    '''A digest of the rhymes `prons` give to each character, which is all
+    the rhyme pair index depends on besides the text'''
+    table = get_rhyme_table(prons)
+    return hashlib.sha1(json.dumps(sorted(table.items()),
+                                   ensure_ascii=False).encode()).hexdigest()
+
+
+def save_rhyme_pair_index(index, signature, filename):
+    with open(filename, 'w') as g:
+        json.dump({'signature': signature,
+                   'pairs': [[a, b, sorted(positions)]
+                             for (a, b), positions in index.items()]},
+                  g, ensure_ascii=False)
+
+
+def load_rhyme_pair_index(filename):
+    '''Returns the stored signature and index'''
+    with open(filename) as f:
+        stored = json.load(f)
+    return stored['signature'], {(a, b): frozenset(positions)
+                                 for a, b, positions in stored['pairs']}
+
+
+def get_rhyme_pair_index(name, poems, prons):
+    '''Loads the index stored with the snapshot of collection `name`, or
+    builds it from `poems`, whose pronunciations are `prons`; the stored
+    index is only used, and only written, when `poems` match the snapshot,
+    and it is rebuilt when the rhymes of `prons` change'''
+    if not isinstance(poems, Sequence):
+        poems = list(poems)
+    filename = os.path.join(get_snapshot_path(name), RHYME_PAIR_INDEX)
+    signature = get_rhyme_signature(prons)
+    stored = matches_snapshot(name, poems)
+    if stored:
+        try:
+            stored_signature, index = load_rhyme_pair_index(filename)
+            if stored_signature == signature:
+                return index
+        except FileNotFoundError:
+            pass
+
+    index = build_rhyme_pair_index(poems)
+    if stored:
+        save_rhyme_pair_index(index, signature, filename)
+    return index
+
+
+def get_corpus_rhyme_pair_index(corpus):
+    '''Builds the index of a Corpus once, alongside its other indexes'''
+    if 'rhyme_pairs' not in corpus.indexes:
+        corpus.indexes['rhyme_pairs'] = build_rhyme_pair_index(corpus)
+    return corpus.indexes['rhyme_pairs']
+
+
+# Character n-grams: every unigram and bigram of the corpus => its positions
+# in the text of all the poems laid end to end (see poem.encode_poems), from
+# which the poem, paragraph and offset are recovered
+
+
+def get_gram_key(gram):
+    if len(gram) == 1:
+        return ord(gram)
+    return BIGRAM | ord(gram[0]) << 21 | ord(gram[1])
+
+
+def build_ngram_index(poems):
+    if isinstance(poems, Corpus):  # read from the snapshot arrays
+        codes, line_offsets, poem_offsets = poems.encode()
+        ids = poems.get_column('id')
+    else:
+        poems = list(poems)
+        codes, line_offsets, poem_offsets = encode_poems(poems)
+        ids = [poem.get('id') for poem in poems]
+    codes = codes.astype(np.int64)
+
+    # bigrams do not span two lines
+    line_start = np.zeros(len(codes) + 1, dtype=bool)
+    line_start[line_offsets] = True
+    bigrams = np.flatnonzero(~line_start[1:-1])
+
+    keys = np.concatenate([codes,
+                           BIGRAM | codes[bigrams] << 21 | codes[bigrams+1]])
+    positions = np.concatenate([np.arange(len(codes)), bigrams])
+    order = np.argsort(keys, kind='stable')  # positions stay sorted
+    keys, starts = np.unique(keys[order], return_index=True)
+
+    return NgramIndex(keys=keys,
+                      starts=np.append(starts, len(order)),
+                      positions=positions[order].astype(np.uint32),
+                      line_offsets=line_offsets,
+                      poem_offsets=poem_offsets,
+                      ids=np.array([id or '' for id in ids]))
+
+
+def save_ngram_index(index, filename):
+    with open(filename, 'wb') as g:
+        np.savez(g, **index._asdict())
+
+
+def load_ngram_index(filename):
+    with np.load(filename) as npz:
+        return NgramIndex(**{field: npz[field]
+                             for field in NgramIndex._fields})
+
+
+def get_ngram_index(name, poems):
+    '''Loads the index stored with the snapshot of collection `name`, or
+    builds it from `poems`; the stored index is only used, and only written,
+    when `poems` match the snapshot'''
+    if not isinstance(poems, Sequence):
+        poems = list(poems)
+    filename = os.path.join(get_snapshot_path(name), NGRAM_INDEX)
+    stored = matches_snapshot(name, poems)
+    if stored:
+        try:
+            index = load_ngram_index(filename)
+            if len(index.poem_offsets) - 1 == len(poems):
+                return index
+        except FileNotFoundError:
+            pass
+
+    index = build_ngram_index(poems)
+    if stored:
+        save_ngram_index(index, filename)
+    return index
+
+
+def lookup(index, gram):
+    key = get_gram_key(gram)
+    i = np.searchsorted(index.keys, key)
+    if i == len(index.keys) or index.keys[i] != key:
+        return index.positions[:0]
+    return index.positions[index.starts[i]:index.starts[i+1]]
+
+
+def find_phrase(index, phrase):
+    '''Returns the positions where `phrase` starts, by intersecting the
+    positions of its overlapping bigrams'''
+    if len(phrase) < 2:
+        return lookup(index, phrase)
+    return reduce(np.intersect1d,
+                  (lookup(index, phrase[i:i+2]).astype(np.int64) - i
+                   for i in range(len(phrase) - 1)))
+
+
+def get_locations(index, positions):
+    '''Converts positions into (poem index, paragraph index, offset)'''
+    lines = np.searchsorted(index.line_offsets, positions, side='right') - 1
+    poems = np.searchsorted(index.poem_offsets, lines, side='right') - 1
+    return zip(poems.tolist(),
+               (lines - index.poem_offsets[poems]).tolist(),
+               (positions - index.line_offsets[lines]).tolist())
+
+
+def get_id(index, poem):
+    return str(index.ids[poem]) or None
+
+
+def search(index, phrase):
+    '''Returns the (poem id, paragraph index, offset) of each occurrence of
+    `phrase`'''
+    positions = find_phrase(index, phrase)
+    return [(get_id(index, poem), para, offset)
+            for poem, para, offset in get_locations(index, positions)]
+
+
+def search_all(index, phrases):
+    '''Returns the (poem id, paragraph index) of the lines that contain all
+    the `phrases`'''
+    lines = reduce(np.intersect1d,
+                   (np.unique(np.searchsorted(index.line_offsets,
+                                              find_phrase(index, phrase),
+                                              side='right') - 1)
+                    for phrase in phrases))
+    poems = np.searchsorted(index.poem_offsets, lines, side='right') - 1
+    return [(get_id(index, poem), para)
+            for poem, para in zip(poems.tolist(),
+                                  (lines - index.poem_offsets[poems]).tolist())
+            ]
+
+
+def concordance(index, poems, phrase, width=5):
+    '''Keyword in context: each occurrence of `phrase` with the `width`
+    characters around it in its line; `poems` must be the sequence the index
+    was built from'''
+    collections = getattr(poems, 'collections', None)
+    ret = list()
+    for poem, para, offset in get_locations(index, find_phrase(index, phrase)):
+        line = poems[poem]['paragraphs'][para]
+        end = offset + len(phrase)
+        ret.append({'id': poems[poem].get('id'),
+                    'author': poems[poem].get('author'),
+                    'collection': collections and collections[poem],
+                    'paragraph': para,
+                    'offset': offset,
+                    'left': line[max(offset - width, 0):offset],
+                    'match': line[offset:end],
+                    'right': line[end:end + width],
+                    })
+    return ret
@@ -4,7 +4,7 @@ import random
 import re
 from collections import Counter
 from copy import deepcopy
-from itertools import chain, compress, starmap
+from itertools import compress, starmap
 from multiprocessing.pool import Pool
 from operator import attrgetter, itemgetter, mul
 from os import cpu_count
@@ -29,11 +29,13 @@ from ds.authors import (NORTH, SOUTH, cache_authors, filter_by_area,
                         load_authors)
 from ds.community import (align_communities, get_community_rhyme_categories,
                           get_top_missing)
-from ds.corpus import CORPORA, filter_by_authors, get_corpus
+from ds.corpus import CORPORA, Corpus, filter_by_authors, get_corpus
 from ds.graph import (build_graph, get_communities, get_community_graph,
                       keep_only_communities, plot)
 from ds.helpers import filter_constraint, takewhile_cdf
-from ds.pronunciation import get_pronunciation, get_rhyme
+from ds.index import get_corpus_rhyme_pair_index, query_rhyme_pair_index
+from ds.poem import PoemContext
+from ds.pronunciation import BACKENDS, get_pronunciation, get_rhyme
 from ds.replacements import replacements
 from ds.sbgy import load_sbgy
 
@@ -41,7 +43,8 @@ from ds.sbgy import load_sbgy
 def build(corpus):
     ret = dict()
     prons = get_pronunciation()
-    ret['poems'] = corpus
+    # a Corpus, which annotator.find_poems selects from by id
+    ret['poems'] = corpus if isinstance(corpus, Corpus) else Corpus(corpus)
     ret['graph'] = build_graph(ret['poems'])
     try:
         ret['communities'] = get_communities(ret['graph'])
@@ -55,6 +58,10 @@ def build(corpus):
 
 
 def filter_poem_with_rime(rhyme_pair, corpus):
+    if isinstance(corpus, Corpus):
+        hits = query_rhyme_pair_index(get_corpus_rhyme_pair_index(corpus),
+                                      rhyme_pair)
+        return [corpus[i] for i in sorted(hits)]
     return filter(lambda poem: poem.find_rhyme_pairs(rhyme_pair), corpus)
 
 
@@ -62,28 +69,31 @@ def filter_poem_with_rime(rhyme_pair, corpus):
 if True:
     parser = argparse.ArgumentParser()
     parser.add_argument('collection', choices=CORPORA.keys(), nargs='+')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes used to decode the corpus files')
+    parser.add_argument('--backend', choices=BACKENDS, default='edoc',
+                        help='source of the pronunciations (sbgy is offline)')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='load the corpus from a snapshot in cache/')
     args = parser.parse_args()
 
     # Load authors and corpus
     all_authors = list()
     authors = dict()
-    corpus = list()
-    all_chars = set()
+    corpus = Corpus()
     for coll in args.collection:
         # cache_authors(coll)
         unambiguous = keep_only_unambiguous(load_authors(coll))
         authors[coll.upper()] = unambiguous
         all_authors.extend(unambiguous)
-        corpus.extend(get_corpus(coll))
-        all_chars |= set(
-            chain.from_iterable(chain.from_iterable(poem['paragraphs']
-                                                    for poem in corpus)))
+        corpus.extend(get_corpus(coll, workers=args.workers,
+                                 snapshot=args.snapshot))
+    all_chars = set(map(chr, set(corpus.encode().codes.tolist())))
 
-    prons = get_pronunciation(chars=all_chars | set(replacements.values()))
+    prons = get_pronunciation(chars=all_chars | set(replacements.values()),
+                              backend=args.backend)
     sbgy = load_sbgy()
-    for poem in corpus:
-        poem['prons'] = prons
-        poem['sbgy'] = sbgy
+    corpus.set_context(PoemContext(prons, sbgy))  # shared by every poem
 
     # Set various segmentations of the corpus
     authors.update({
@@ -1,63 +1,273 @@
 import regex as re
-from collections import Counter
-from itertools import chain, product
+from collections import Counter, namedtuple
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from itertools import chain, product, repeat
 from operator import itemgetter
 
-from .community import community_node_to_set
-from .helpers import window, window_combinations
-from .pronunciation import apply_tongyong, get_rhyme
+import numpy as np
 
+from .community import build_community_index, get_community_index
+from .helpers import encode_strings, window_combinations
+from .pronunciation import get_rhyme_table
 
-class Poem(dict):
-    def get_rhymes(self, lines=None, split=False):
-        # this needs improvement: not every character will be a rhyme
-        patt = r'，。？）\]」'
-        end = '' if split else '$'
-
-        return [last_char
-                for line in (lines or self['paragraphs'])
-                # add $ to force end of line
-                for last_char in re.findall(f'([^{patt}])[{patt}]+{end}', line)
-                ]
-
-    def get_rhyme_categories(self, apply_eq=False):
-        # retrieve characters that are in rhyme position
-        rhymes = self.get_rhymes()
-
-        # obtain their GY rhyme: many will have several possibilities
-        # e.g. 長 => 陽 / 漾 / 養
-        rhyme_gen = map(lambda rh: get_rhyme(rh, self['prons']), rhymes)
-        if apply_eq:
-            rhyme_gen = map(lambda cats:
-                            map(lambda cat: apply_tongyong(cat, self['sbgy']),
-                                cats),
-                            rhyme_gen)
-        rhyme_sets = list(map(frozenset, rhyme_gen))
-
-        # disambiguate by looking at which rhymes would actually rhyme
-        # e.g. if the line before/after contains 章 (陽 as the only possible
-        # rhyme), then 長 must be read as the 陽 rhyme too.
-        gy_rhymes = list()
-        window_size = 3  # look 2 lines before and after
-
-        for w in window(rhyme_sets, window_size, pad=True):
-            candidate = w.pop(window_size//2)
-            surrounding = set(chain.from_iterable(w))
-            if len(candidate) > 1 and len(candidate & surrounding) > 0:
+RHYME_PUNCTUATION = '，。？）]」'
+PUNCTUATION_CLASS = re.escape(RHYME_PUNCTUATION)
+RHYME_PATTERNS = {
+    # add $ to force end of line
+    False: re.compile(f'([^{PUNCTUATION_CLASS}])[{PUNCTUATION_CLASS}]+$'),
+    True: re.compile(f'([^{PUNCTUATION_CLASS}])[{PUNCTUATION_CLASS}]+'),
+}
+CACHE_STATS = Counter()
+# every GY rhyme (or tongyong group) gets a bit, so that sets of rhymes can be
+# handled as integer masks
+RHYME_BITS = dict()
+TABLE_MASKS = dict()  # interned tuple of a rhyme table => mask
+MASK_CATEGORIES = {0: '?'}
+EncodedPoems = namedtuple('EncodedPoems',
+                          ['codes', 'line_offsets', 'poem_offsets'])
+
+
+def get_cache_stats():
+    '''Returns the hits and misses of the poems' rhyme caches'''
+    return Counter(CACHE_STATS)
+
+
+def reset_cache_stats():
+    CACHE_STATS.clear()
+
+
+def find_rhymes(lines, split=False):
+    # this needs improvement: not every character will be a rhyme
+    return [last_char
+            for line in lines
+            for last_char in RHYME_PATTERNS[split].findall(line)]
+
+
+def get_rhyme_mask(rhymes):
+    mask = 0
+    for rhyme in rhymes:
+        if rhyme not in RHYME_BITS:
+            RHYME_BITS[rhyme] = 1 << len(RHYME_BITS)
+        mask |= RHYME_BITS[rhyme]
+    return mask
+
+
+def get_category(mask):
+    if mask not in MASK_CATEGORIES:
+        MASK_CATEGORIES[mask] = ''.join(sorted(
+            rhyme for rhyme, bit in RHYME_BITS.items() if mask & bit))
+    return MASK_CATEGORIES[mask]
+
+
+def get_table_mask(rhymes):
+    if rhymes not in TABLE_MASKS:
+        TABLE_MASKS[rhymes] = get_rhyme_mask(rhymes)
+    return TABLE_MASKS[rhymes]
+
+
+def get_char_mask(char, prons, sbgy=None):
+    # obtain the GY rhyme: many will have several possibilities
+    # e.g. 長 => 陽 / 漾 / 養
+    return get_table_mask(get_rhyme_table(prons, sbgy).get(char, ()))
+
+
+def disambiguate_masks(masks):
+    '''Disambiguates by looking at which rhymes would actually rhyme, e.g. if
+    the line before/after contains 章 (陽 as the only possible rhyme), then 長
+    must be read as the 陽 rhyme too'''
+    ret = list()
+    last = len(masks) - 1
+    for i, mask in enumerate(masks):
+        if mask & (mask - 1):  # more than one possibility
+            surrounding = ((masks[i-1] if i > 0 else 0) |
+                           (masks[i+1] if i < last else 0))
+            if mask & surrounding:
                 # reduce to the set of possibilities (usu. down to 1)
-                gy_rhymes.append(frozenset(candidate & surrounding))
-            else:
-                gy_rhymes.append(candidate)
+                mask &= surrounding
+        ret.append(mask)
+    return ret
+
+
+def get_rhyme_categories_batch(poems, apply_eq=False, rhymes=None):
+    '''Poem.get_rhyme_categories over many poems, with their rhymes given
+    or found beforehand'''
+    ret = list()
+    for poem, poem_rhymes in zip(poems, rhymes or repeat(None)):
+        if poem_rhymes is None:
+            poem_rhymes = poem.get_rhymes()
+        ret.append(poem.compute_rhyme_categories(apply_eq, poem_rhymes))
+    return ret
+
+
+class PoemContext:
+    '''Tables shared by all the poems of a corpus; `version` is bumped
+    whenever a table is replaced, which invalidates the poems' caches'''
+    __slots__ = ('prons', 'sbgy', 'version')
+
+    def __init__(self, prons=None, sbgy=None):
+        self.prons = prons
+        self.sbgy = sbgy
+
+    def __setattr__(self, name, value):
+        if name != 'version':
+            object.__setattr__(self, 'version',
+                               getattr(self, 'version', 0) + 1)
+        object.__setattr__(self, name, value)
+
+    def replace(self, **kwargs):
+        return PoemContext(**{'prons': self.prons, 'sbgy': self.sbgy,
+                              **kwargs})
+
+
+class Poem(MutableMapping):
+    '''A poem behaves like the dict it was read from, but its usual fields
+    are stored in slots, and the pronunciation and SBGY tables ('prons' and
+    'sbgy') in a context object shared with the other poems of the corpus'''
+    FIELDS = ('id', 'title', 'author', 'paragraphs')
+    CONTEXT_FIELDS = ('prons', 'sbgy')
+    __slots__ = FIELDS + ('extra', 'context', 'cache')
+
+    def __init__(self, *args, context=None, **kwargs):
+        self.extra = None
+        self.context = context
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if key in self.CONTEXT_FIELDS:
+            value = getattr(self.context, key, None)
+            if value is None:
+                raise KeyError(key)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
 
-        return [''.join(sorted(gy)) or '?' for gy in gy_rhymes]
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        elif key in self.CONTEXT_FIELDS:
+            # copy on write: the context may be shared with other poems
+            self.context = (self.context or PoemContext()).replace(
+                **{key: value})
+        else:
+            if self.extra is None:
+                self.extra = dict()
+            self.extra[key] = value
 
-    def get_rhyme_communities(self, communities):
-        community_sets = list(map(community_node_to_set, communities))
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif key in self.CONTEXT_FIELDS:
+            self[key]  # raises KeyError if missing
+            self.context = self.context.replace(**{key: None})
+        else:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+
+    def __iter__(self):
+        # the context tables are not part of the poem's own keys
+        for field in self.FIELDS:
+            if hasattr(self, field):
+                yield field
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+
+    def __setattr__(self, name, value):
+        if name in ('paragraphs', 'context'):
+            object.__setattr__(self, 'cache', None)
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        if name in ('paragraphs', 'context'):
+            object.__setattr__(self, 'cache', None)
+        object.__delattr__(self, name)
+
+    def __getstate__(self):
+        # the cached results are not worth pickling
+        return None, {**{slot: getattr(self, slot)
+                         for slot in self.__slots__
+                         if hasattr(self, slot)},
+                      'cache': None}
+
+    def cached(self, key, compute):
+        '''Memoizes the results of the rhyme analysis: the cache is dropped
+        when the paragraphs or the context change (but not when the list of
+        paragraphs is modified in place)'''
+        version = getattr(self.context, 'version', None)
+        if self.cache is None or self.cache[0] != version:
+            self.cache = (version, dict())
+        results = self.cache[1]
+        if key in results:
+            CACHE_STATS['hits'] += 1
+        else:
+            CACHE_STATS['misses'] += 1
+            results[key] = compute()
+        return list(results[key])
+
+    @contextmanager
+    def given_rhymes(self, rhymes, split=False):
+        '''Within the block, get_rhymes returns rhymes found beforehand, e.g.
+        by get_corpus_rhymes, instead of running the regex; the cache of the
+        poem is left as it was'''
+        saved = self.cache
+        self.cache = None
+        self.cached(('rhymes', split), lambda: list(rhymes))
+        try:
+            yield self
+        finally:
+            self.cache = saved
+
+    def get_rhymes(self, lines=None, split=False):
+        if lines:
+            return find_rhymes(lines, split)
+        return self.cached(('rhymes', split),
+                           lambda: find_rhymes(self['paragraphs'], split))
+
+    def get_rhyme_categories(self, apply_eq=False, rhymes=None):
+        if rhymes is None:
+            return self.cached(('categories', apply_eq),
+                               lambda: self.compute_rhyme_categories(
+                                   apply_eq, self.get_rhymes()))
+        return self.compute_rhyme_categories(apply_eq, rhymes)
+
+    def compute_rhyme_categories(self, apply_eq, rhymes):
+        sbgy = self['sbgy'] if apply_eq and rhymes else None
+        table = get_rhyme_table(self['prons'], sbgy)
+        masks = [get_table_mask(table.get(rh, ())) for rh in rhymes]
+        return list(map(get_category, disambiguate_masks(masks)))
+
+    def get_rhyme_communities(self, communities, index=None):
+        '''`index` is the build_community_index of the communities, when
+        annotating many poems with the same communities'''
+        if index is None:
+            index = get_community_index(communities)
+        token = getattr(index, 'token', None)
+        if token is None:  # a plain dict
+            return self.compute_rhyme_communities(index)
+        return self.cached(('communities', token),
+                           lambda: self.compute_rhyme_communities(index))
+
+    def compute_rhyme_communities(self, index):
         ret = list()
-        community_candidates = [
-            [i for i, comm in enumerate(community_sets) if rhyme in comm]
-            for rhyme in self.get_rhymes()
-            ]
+        community_candidates = [index.get(rhyme, ())
+                                for rhyme in self.get_rhymes()]
         counts = Counter(chain.from_iterable(community_candidates))
         for candidates in community_candidates:
             if len(candidates) == 1:
@@ -102,15 +312,16 @@ class Poem(dict):
         return self.groups_to_annotations(
             self.get_rhyme_categories(apply_tongyong))
 
-    def get_community_annotations(self, communities):
+    def get_community_annotations(self, communities, index=None):
         return self.groups_to_annotations(
-            self.get_rhyme_communities(communities))
+            self.get_rhyme_communities(communities, index))
 
     def annotate_on_category(self, apply_tongyong=False):
         return self.annotate(self.get_category_annotations(apply_tongyong))
 
-    def annotate_on_community(self, communities):
-        return self.annotate(self.get_community_annotations(communities))
+    def annotate_on_community(self, communities, index=None):
+        return self.annotate(self.get_community_annotations(communities,
+                                                            index))
 
     def find_rhyme_pairs(self, pair):
         gy_rhymes = self.get_rhyme_categories()
@@ -118,3 +329,87 @@ class Poem(dict):
                                          window_combinations(gy_rhymes, 2))))
         searched_pairs = set(map(tuple, map(sorted, product(*pair))))
         return set(searched_pairs) & set(rhyme_pairs)
+
+
+def annotate_on_community(poems, communities):
+    '''Poem.annotate_on_community over a whole corpus, looking up the
+    communities of each rhyme in a single index'''
+    index = build_community_index(communities)
+    return [poem.annotate(poem.groups_to_annotations(
+                poem.compute_rhyme_communities(index)))
+            for poem in poems]
+
+
+# Whole corpus rhyme extraction: the text of all the poems is encoded once as
+# an array of code points, and the rhyme positions are found with array
+# operations instead of running a regex over each line
+
+
+def encode_poems(poems):
+    poems = list(poems)
+    codes, line_offsets = encode_strings(
+        chain.from_iterable(poem['paragraphs'] for poem in poems))
+    poem_offsets = np.zeros(len(poems) + 1, dtype=np.int64)
+    np.cumsum([len(poem['paragraphs']) for poem in poems],
+              out=poem_offsets[1:])
+    return EncodedPoems(codes, line_offsets, poem_offsets)
+
+
+def concat_encoded(parts):
+    '''Lays several EncodedPoems end to end, as encode_poems of all their
+    poems would'''
+    parts = [part for part in parts if len(part.poem_offsets) > 1]
+    if len(parts) < 2:
+        return parts[0] if parts else encode_poems([])
+    code_starts = np.cumsum([0] + [len(part.codes) for part in parts])
+    line_starts = np.cumsum([0] + [len(part.line_offsets) - 1
+                                   for part in parts])
+    return EncodedPoems(
+        np.concatenate([part.codes for part in parts]),
+        np.concatenate([[0]] + [part.line_offsets[1:] + start for part, start
+                                in zip(parts, code_starts)]),
+        np.concatenate([[0]] + [part.poem_offsets[1:] + start for part, start
+                                in zip(parts, line_starts)]))
+
+
+def get_rhyme_positions(encoded, split=False):
+    '''Returns the positions of the rhyme characters in `encoded.codes` and
+    the index of the line each of them belongs to, as Poem.get_rhymes would
+    find them'''
+    codes, line_offsets, _ = encoded
+    punct = np.isin(codes, np.array(list(map(ord, RHYME_PUNCTUATION)),
+                                    dtype=codes.dtype))
+    starts, ends = line_offsets[:-1], line_offsets[1:]
+
+    if split:
+        # every non punctuation followed by punctuation on the same line
+        line_start = np.zeros(len(codes) + 1, dtype=bool)
+        line_start[starts] = True
+        positions = np.flatnonzero(~punct[:-1] & punct[1:] &
+                                   ~line_start[1:-1])
+        lines = np.searchsorted(line_offsets, positions, side='right') - 1
+        return positions, lines
+
+    # last non punctuation before the punctuation that ends the line (like
+    # the regex $, ignoring a single trailing newline)
+    last_char = np.maximum.accumulate(
+        np.where(punct, -1, np.arange(len(codes))))
+    last = np.maximum(ends - 1, 0)
+    valid = ends > starts
+    last[valid] -= codes[last[valid]] == ord('\n')
+    valid &= last >= starts
+    valid[valid] &= punct[last[valid]]
+    positions = last_char[last[valid]]
+    valid[valid] &= positions >= starts[valid]
+    lines = np.flatnonzero(valid)
+    return last_char[last[lines]], lines
+
+
+def get_corpus_rhymes(encoded, split=False):
+    '''Returns the rhyme characters of each poem, in a single pass over the
+    encoded corpus'''
+    positions, lines = get_rhyme_positions(encoded, split=split)
+    text = encoded.codes[positions].tobytes().decode('utf-32-le',
+                                                     'surrogatepass')
+    poem_offsets = np.searchsorted(lines, encoded.poem_offsets).tolist()
+    return [list(text[a:b]) for a, b in zip(poem_offsets, poem_offsets[1:])]
@@ -1,16 +1,29 @@
 import csv
+import json
+import os
 import re
-from collections import defaultdict
+import sqlite3
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import lru_cache
-from itertools import filterfalse, zip_longest
-from time import sleep
+from html.parser import HTMLParser
+from itertools import chain, zip_longest
+from operator import itemgetter
+from threading import Lock
+from time import monotonic, sleep, time
+from types import MappingProxyType
 
 import requests
 from bs4 import BeautifulSoup
 
+from .helpers import get_cached_by_id
 from .replacements import replacements
+from .sbgy import get_tongyong_map, load_sbgy_pronunciations
 
 CACHE_FILE = 'cache/pronunciation.cache.csv'
+STORE_FILE = 'cache/pronunciation.sqlite'
+MAX_PARAMS = 900  # below SQLite's default limit of host parameters
 EDOC_URL = 'http://edoc.uchicago.edu/edoc2013/digitaledoc_linearformat.php'
 EDOC_FIELDS = (('qygy[]', 'QYRhymeName'),
                ('qygy[]', 'GYRhymeName'),
@@ -29,142 +42,468 @@ EDOC_FIELDS = (('qygy[]', 'QYRhymeName'),
                ('edoc[]', 'QY_IPA'),
                )
 MAX_CHARS = 200
+CONCURRENCY = 4
+RATE = 1  # requests per second
+RETRIES = 3
+BACKOFF = 1  # seconds, doubled at each retry
+TIMEOUT = 60
+NEGATIVE_TTL = 30 * 24 * 3600  # seconds before asking again for a character
+BACKENDS = ('edoc', 'sbgy')
+MAX_RHYME_TABLES = 8
+RHYME_TABLES = OrderedDict()  # see helpers.get_cached_by_id
+# store file => char => readings, shared by all the views of that store
+LOADED = dict()
+COMPLETE = set()  # the store files that are loaded entirely
+BAXTER_Y = re.compile('^y')
+BAXTER_FINAL = re.compile('[aæeɛiɨjouw][^ HX]*')
+# applied in order: later rules see the output of the earlier ones
+SCHUESSLER_REWRITES = [(re.compile(pattern), repl) for pattern, repl in (
+    ('jwo(?=[kŋ])', 'jow'),
+    ('jwo', 'jo'),
+    ('juən', 'jun'),
+    ('uən', 'won'),
+    ('uo', 'u'),
+    ('ɐ(?=[kŋ])', 'æ'),
+    ('ŋ', 'ng'),
+    ('âu', 'aw'),
+    ('juən', 'jun'),  # again: uo => u can form it
+    ('uậi', 'woj'),
+    ('jɛt', 'it'),  # ?
+    ('ä(?=[nt])', 'e'),
+    ('jä', 'jie'),
+    ('ăn', 'ean'),
+    ('â', 'a'),
+    ('ə', 'o'),
+    ('̣', ''),
+)]
+SCHUESSLER_FINAL = re.compile('[aæeijouw][^ᶜᴮ ,]*')
+
+
+class TokenBucket:
+    '''Allows `rate` requests per second on average, and bursts of up to
+    `capacity` requests'''
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            wait = (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            # sleeping with the lock held keeps the requests in line
+            if wait > 0:
+                sleep(wait)
+
+
+def get_html(chars):
+    url_dic = [('text_input', chars),
+               ('Run_button', 'Display Phonetics'),
+               *EDOC_FIELDS,
+               ]
+
+    response = requests.post(EDOC_URL, data=url_dic, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.text
+
+
+class EdocParser(HTMLParser):
+    '''Collects the text of the cells of the third table of an edoc page as
+    the page is fed, without building a tree; a <td> or <tr> closes the cell
+    or row left open before it'''
+
+    def __init__(self):
+        super().__init__()
+        self.tables = 0
+        self.depth = 0  # tables open inside the result table
+        self.rows = list()
+        self.row = None
+        self.cell = None
+
+    def end_cell(self):
+        if self.cell is not None:
+            self.row.append(''.join(self.cell))
+            self.cell = None
+
+    def end_row(self):
+        self.end_cell()
+        if self.row is not None:
+            self.rows.append(self.row)
+            self.row = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self.tables += 1
+            if self.depth or self.tables == 3:
+                self.depth += 1
+        elif not self.depth:
+            return
+        elif tag == 'tr':
+            self.end_row()
+            self.row = list()
+        elif tag == 'td' and self.row is not None:
+            self.end_cell()
+            self.cell = list()
+
+    def handle_endtag(self, tag):
+        if not self.depth:
+            return
+        if tag == 'td':
+            self.end_cell()
+        elif tag == 'tr':
+            self.end_row()
+        elif tag == 'table':
+            self.depth -= 1
+            if not self.depth:
+                self.end_row()
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+
+def rows_to_entries(keys, rows):
+    ret = []
+    for row in rows:
+        dic = dict()
+        for position, text in enumerate(row):
+            dic[keys[position]] = text
+        dic.pop('')
+        ret.append(dic)
+    for i, entry in enumerate(ret):
+        if len(entry['Graph']) == 0:
+            ret[i]['Graph'] = ret[i-1]['Graph']
+    return ret
 
 
-def query_edoc(chars):
-    def get_html(chars):
-        url_dic = [('text_input', chars),
-                   ('Run_button', 'Display Phonetics'),
-                   *EDOC_FIELDS,
-                   ]
-
-        return requests.post(EDOC_URL, data=url_dic).text
-
-    def parse_result(html_string):
-        ret = []
-        soup = BeautifulSoup(html_string, 'html.parser')
-        table = soup.findAll('table')[2]
-        tr = table.find('tr')
-        keys = tr.findAll('td')
-        for tr in table.findAll('tr')[1:]:
-            dic = dict()
-            position = 0
-            for td in tr.findAll('td'):
-                dic[keys[position].text] = td.text
-                position += 1
-            dic.pop('')
-            ret.append(dic)
-        for i, entry in enumerate(ret):
-            if len(entry['Graph']) == 0:
-                ret[i]['Graph'] = ret[i-1]['Graph']
-        return ret
-
-    chunks = [list(filter(None, chunk))
-              for chunk in zip_longest(*([iter(chars)] * MAX_CHARS))]
+def parse_result(html_string):
+    parser = EdocParser()
+    parser.feed(html_string)
+    parser.close()
+    parser.end_row()  # the page may be cut short
+    if parser.tables < 3 or not parser.rows:
+        raise IndexError('no result table')
+    return rows_to_entries(parser.rows[0], parser.rows[1:])
+
+
+def parse_result_soup(html_string):
+    '''parse_result through a BeautifulSoup tree, slower'''
+    soup = BeautifulSoup(html_string, 'html.parser')
+    table = soup.findAll('table')[2]
+    keys = [td.text for td in table.find('tr').findAll('td')]
+    return rows_to_entries(keys, ([td.text for td in tr.findAll('td')]
+                                  for tr in table.findAll('tr')[1:]))
+
+
+def query_chunk(chunk, bucket, retries):
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            return parse_result(get_html(chunk))
+        except (requests.RequestException, IndexError) as e:
+            if attempt == retries:
+                raise
+            print(f'Retrying after {e!r}')
+            sleep(BACKOFF * 2 ** attempt)
 
-    ret = list()
-    for i, chunk in enumerate(chunks, start=1):
-        print(f'Chunk {i}/{len(chunks)}')
-        ret.extend(parse_result(get_html((''.join(chunk)))))
-        if i != 1:
-            sleep(1)
 
-    return ret
+def query_edoc(chars, on_chunk=None, concurrency=CONCURRENCY, rate=RATE,
+               retries=RETRIES):
+    '''Queries edoc by chunks of MAX_CHARS characters, `concurrency` at a
+    time and at most `rate` per second, and calls `on_chunk` (in this thread)
+    with the results of each chunk as soon as it arrives'''
+    chunks = [''.join(filter(None, chunk))
+              for chunk in zip_longest(*([iter(chars)] * MAX_CHARS))]
+    bucket = TokenBucket(rate)
+    results = [None] * len(chunks)
+    error = None
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = {executor.submit(query_chunk, chunk, bucket, retries): i
+                   for i, chunk in enumerate(chunks)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            print(f'Chunk {done}/{len(chunks)}')
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                # keep saving the other chunks, raise at the end
+                error = error or e
+                continue
+            if on_chunk is not None:
+                on_chunk(results[futures[future]])
 
+    if error is not None:
+        raise error
+    return list(chain.from_iterable(results))
 
-def get_and_cache_pronunciation(chars):
-    ret = query_edoc(chars)
 
-    cache = load_cache()
-    for line in ret:
-        cache[line['Graph']].append(line)
-    dump_cache(cache, fields=list(line.keys()))
+def get_and_cache_pronunciation(chars):
+    query_edoc(chars, on_chunk=insert_pronunciations)
 
 
-def dump_cache(cache, fields):
-    with open(CACHE_FILE, 'w', newline='') as g:
-        writer = csv.DictWriter(g, fieldnames=fields)
-        writer.writeheader()
-        for char in cache.values():
-            for line in char:
-                writer.writerow(line)
-    load_cache.cache_clear()
+# The pronunciations are stored in SQLite, one row per reading, indexed on the
+# character. The CSV cache of earlier versions is imported when the store is
+# created.
 
 
 @lru_cache()
-def load_cache():
-    ret = defaultdict(list)
+def connect(filename):
+    new = not os.path.exists(filename)
+    conn = sqlite3.connect(filename)
+    conn.execute('''CREATE TABLE IF NOT EXISTS pronunciation (
+                        graph TEXT NOT NULL,
+                        entry TEXT NOT NULL)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS pronunciation_graph
+                    ON pronunciation (graph)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS finals (
+                        graph TEXT PRIMARY KEY,
+                        finals TEXT NOT NULL)''')
+    # characters edoc could not resolve, and when it was last asked
+    conn.execute('''CREATE TABLE IF NOT EXISTS unresolved (
+                        graph TEXT PRIMARY KEY,
+                        checked REAL NOT NULL)''')
+    conn.commit()
+    if new:
+        import_csv(conn, CACHE_FILE)
+    return conn
+
+
+def get_store():
+    return connect(STORE_FILE)
+
+
+def import_csv(conn, csv_file):
     try:
-        with open(CACHE_FILE) as f:
-            reader = csv.DictReader(f)
-            for line in reader:
-                ret[line['Graph']].append(line)
+        with open(csv_file) as f:
+            insert_pronunciations(csv.DictReader(f), conn)
     except FileNotFoundError:
         pass
+
+
+def insert_pronunciations(lines, conn=None):
+    loaded = LOADED.get(STORE_FILE) if conn is None else None
+    conn = conn or get_store()
+    lines = list(lines)
+    with conn:
+        conn.executemany('INSERT INTO pronunciation VALUES (?, ?)',
+                         ((line['Graph'], json.dumps(line, ensure_ascii=False))
+                          for line in lines))
+        # the finals of these characters are computed again
+        conn.executemany('DELETE FROM finals WHERE graph = ?',
+                         {(line['Graph'],) for line in lines})
+    if loaded is not None:  # keep the views up to date
+        loaded.update(lookup_pronunciations({line['Graph'] for line in lines}))
+
+
+def rows_to_pronunciations(rows):
+    ret = defaultdict(list)
+    for graph, entry in rows:
+        ret[graph].append(json.loads(entry))
     return ret
 
+
+def select_in(query, chars, *params):
+    '''Runs `query` (with a {} placeholder for the IN list) over `chars` in
+    batches of at most MAX_PARAMS characters'''
+    chars = list(chars)
+    for i in range(0, len(chars), MAX_PARAMS):
+        batch = chars[i:i+MAX_PARAMS]
+        yield from get_store().execute(
+            query.format(','.join('?' * len(batch))), [*batch, *params])
+
+
+def lookup_pronunciations(chars):
+    '''Reads the entries of `chars` only'''
+    return rows_to_pronunciations(select_in(
+        '''SELECT graph, entry FROM pronunciation
+           WHERE graph IN ({}) ORDER BY rowid''', chars))
+
+
+def lookup_unresolved(chars, ttl=None):
+    '''Returns those of `chars` that edoc failed to resolve in the last `ttl`
+    seconds'''
+    ttl = NEGATIVE_TTL if ttl is None else ttl
+    return set(map(itemgetter(0), select_in(
+        'SELECT graph FROM unresolved WHERE graph IN ({}) AND checked > ?',
+        chars, time() - ttl)))
+
+
+def mark_unresolved(chars):
+    with get_store() as conn:
+        conn.executemany('INSERT OR REPLACE INTO unresolved VALUES (?, ?)',
+                         ((c, time()) for c in chars))
+
+
+def forget_unresolved(chars=None):
+    '''Forgets that `chars` (by default all characters) could not be
+    resolved, so that they are queried again'''
+    with get_store() as conn:
+        if chars is None:
+            conn.execute('DELETE FROM unresolved')
+        else:
+            conn.executemany('DELETE FROM unresolved WHERE graph = ?',
+                             ((c,) for c in chars))
+
+
+def lookup_all_pronunciations():
+    return rows_to_pronunciations(get_store().execute(
+        'SELECT graph, entry FROM pronunciation ORDER BY rowid'))
+
+
+def get_loaded():
+    return LOADED.setdefault(STORE_FILE, dict())
+
+
+def load_pronunciations(chars=None):
+    '''Loads `chars` (by default all characters) from the store into the
+    readings shared by the views'''
+    loaded = get_loaded()
+    if chars is None:
+        if STORE_FILE not in COMPLETE:
+            loaded.update(lookup_all_pronunciations())
+            COMPLETE.add(STORE_FILE)
+    elif STORE_FILE not in COMPLETE:
+        loaded.update(lookup_pronunciations(chars - loaded.keys()))
+    return loaded
+
+
+class PronunciationView(Mapping):
+    '''A read-only view of char => readings, restricted to `chars` if given
+    (the requested characters that have no reading map to an empty list).
+    Creating one copies nothing; the readings must not be modified.'''
+    __slots__ = ('readings', 'chars')
+
+    def __init__(self, readings, chars=None):
+        self.readings = readings
+        self.chars = chars
+
+    def __getitem__(self, c):
+        if self.chars is None:
+            return self.readings[c]
+        if c not in self.chars:
+            raise KeyError(c)
+        return self.readings.get(c, [])
+
+    def __contains__(self, c):
+        return c in (self.readings if self.chars is None else self.chars)
+
+    def __iter__(self):
+        return iter(self.readings if self.chars is None else self.chars)
+
+    def __len__(self):
+        return len(self.readings if self.chars is None else self.chars)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({len(self)} characters)'
+
+    def __reduce__(self):
+        # only what the view shows is sent to other processes
+        return type(self), ({c: self[c] for c in self},)
+
 # tout ce qui est au-dessus est "privé"
 
 
-def get_pronunciation(chars=None):
-    cache = load_cache()
+def get_sbgy_pronunciation(chars=None):
+    '''Reads the pronunciations from the SBGY alone, without the network;
+    the readings only have a GY Rhyme, GY Tone and GY fanqie'''
+    prons = load_sbgy_pronunciations()
+    if chars is not None:
+        chars = frozenset(chars)
+    return PronunciationView(prons, chars)
+
+
+def get_pronunciation(chars=None, refresh=False, backend='edoc'):
+    '''Characters that edoc could not resolve are only queried again after
+    NEGATIVE_TTL seconds, or if `refresh` is set. The 'sbgy' backend works
+    offline.'''
+    if backend == 'sbgy':
+        return get_sbgy_pronunciation(chars)
+    if backend != 'edoc':
+        raise ValueError(f'Unknown backend {backend}, not in {BACKENDS}')
+
     if chars is None:
-        return dict(cache)
+        return PronunciationView(load_pronunciations())
 
-    missing = list(filterfalse(cache.__contains__, set(chars)))
+    chars = frozenset(chars)
+    prons = load_pronunciations(chars)
+    missing = chars - prons.keys()
+    if not refresh:
+        missing -= lookup_unresolved(missing)
 
     if missing:
         print(f'Missing {len(missing)}')
-        get_and_cache_pronunciation(missing)
+        get_and_cache_pronunciation(list(missing))
+        mark_unresolved(missing - prons.keys())
 
-    cache = load_cache()
-
-    return {c: cache[c] for c in set(chars)}  # why not always return cache?
+    return PronunciationView(prons, chars)
 
 
 def get_final(pron):
-    def extract_final_mcf(mcf):
-        if mcf:
-            mcf = re.sub('[+]', 'ɨ', mcf)
-            return mcf
-
-    def extract_final_baxter(bax):
-        if bax:
-            bax = re.sub('^y', 'j', bax)
-            bax = re.sub('æ', 'ae', bax)
-            return '-' + re.search('[aæeɛiɨjouw][^ HX]*', bax).group(0)
-
-    def extract_final_schuessler(sch):
-        if sch:
-            sch = re.sub('jwo(?=[kŋ])', 'jow', sch)
-            sch = re.sub('jwo', 'jo', sch)
-            sch = re.sub('juən', 'jun', sch)
-            sch = re.sub('uən', 'won', sch)
-            sch = re.sub('uo', 'u', sch)
-            sch = re.sub('ɐ(?=[kŋ])', 'æ', sch)
-            sch = re.sub('ŋ', 'ng', sch)
-            sch = re.sub('âu', 'aw', sch)
-            sch = re.sub('juən', 'jun', sch)
-            sch = re.sub('uậi', 'woj', sch)
-            sch = re.sub('jɛt', 'it', sch)  # ?
-            sch = re.sub('ä(?=[nt])', 'e', sch)
-            sch = re.sub('jä', 'jie', sch)
-            sch = re.sub('ăn', 'ean', sch)
-            sch = re.sub('â', 'a', sch)
-            sch = re.sub('ə', 'o', sch)
-            sch = re.sub('̣', '', sch)
-            try:
-                return '-' + re.search('[aæeijouw][^ᶜᴮ ,]*', sch).group(0)
-            except AttributeError:
-                print(sch, pron)
-                raise
-
     return [(extract_final_mcf(subpron['MCF']) or
              extract_final_baxter(subpron['GY Baxter']))
             for subpron in pron
             ] or [extract_final_schuessler(pron[0]['MC/QY'])]
 
 
+def extract_final_mcf(mcf):
+    if mcf:
+        return mcf.replace('+', 'ɨ')
+
+
+def extract_final_baxter(bax):
+    if bax:
+        bax = BAXTER_Y.sub('j', bax).replace('æ', 'ae')
+        return '-' + BAXTER_FINAL.search(bax).group(0)
+
+
+def extract_final_schuessler(sch):
+    if sch:
+        for pattern, repl in SCHUESSLER_REWRITES:
+            sch = pattern.sub(repl, sch)
+        try:
+            return '-' + SCHUESSLER_FINAL.search(sch).group(0)
+        except AttributeError:
+            print(sch)
+            raise
+
+
+# The finals of every character of the store are computed in one go and kept
+# in a table of their own, next to the pronunciations
+
+
+def compute_finals(conn=None):
+    '''Computes the finals of the characters of the store that have none
+    yet'''
+    conn = conn or get_store()
+    prons = rows_to_pronunciations(conn.execute(
+        '''SELECT graph, entry FROM pronunciation
+           WHERE graph NOT IN (SELECT graph FROM finals) ORDER BY rowid'''))
+    with conn:
+        conn.executemany('INSERT INTO finals VALUES (?, ?)',
+                         ((c, json.dumps(get_final(pron), ensure_ascii=False))
+                          for c, pron in prons.items()))
+    return len(prons)
+
+
+def get_finals(chars=None):
+    '''Returns char => finals (see get_final) for `chars`, or for every
+    character of the store'''
+    compute_finals()
+    if chars is None:
+        rows = get_store().execute('SELECT graph, finals FROM finals')
+    else:
+        rows = select_in(
+            'SELECT graph, finals FROM finals WHERE graph IN ({})', set(chars))
+    return {c: json.loads(finals) for c, finals in rows}
+
+
 def get_rhyme(c, prons):
     ret = sorted(set(p['GY Rhyme'] for p in prons[c] if p['GY Rhyme']))
     if not ret and c in replacements:
@@ -178,3 +517,40 @@ def apply_tongyong(rime, sbgy):
         if eq is not None:
             return eq
     return rime
+
+
+def resolve_rhyme(c, prons):
+    '''get_rhyme, following the chain of replacements iteratively'''
+    seen = set()
+    while c not in seen:
+        seen.add(c)
+        ret = sorted(set(p['GY Rhyme'] for p in prons.get(c, ())
+                         if p['GY Rhyme']))
+        if ret or c not in replacements:
+            return ret
+        c = replacements[c]
+    return []
+
+
+def build_rhyme_table(prons, sbgy=None):
+    '''Compiles char => tuple of GY rhymes (or of their tongyong groups, if
+    `sbgy` is given) for every character of `prons` and of the replacements,
+    so that looking up a character is a single dict access. Equal tuples are
+    shared.'''
+    interned = dict()
+    table = dict()
+    tongyong = get_tongyong_map(sbgy) if sbgy is not None else None
+    for c in chain(list(prons), replacements):
+        rhymes = resolve_rhyme(c, prons)
+        if tongyong is not None:
+            rhymes = sorted(set(tongyong.get(rhyme, rhyme)
+                                for rhyme in rhymes))
+        rhymes = tuple(rhymes)
+        table[c] = interned.setdefault(rhymes, rhymes)
+    return MappingProxyType(table)
+
+
+def get_rhyme_table(prons, sbgy=None):
+    '''Builds the rhyme table of `prons` (and `sbgy`) once'''
+    return get_cached_by_id(RHYME_TABLES, MAX_RHYME_TABLES,
+                            build_rhyme_table, prons, sbgy)
@@ -1,47 +1,233 @@
+import json
+import os
 import re
-from collections import namedtuple
+import xml.etree.ElementTree as ET
+from collections import defaultdict, namedtuple
+from itertools import chain
 
-from bs4 import BeautifulSoup
+import numpy as np
+
+from .helpers import hash_file
 
 Rime = namedtuple('Rime', ['rime', 'tone', 'eq', 'duyong'], defaults=[''])
+TongyongClasses = namedtuple('TongyongClasses', ['rhymes', 'ids', 'classes'])
 SBGY = 'third-party/sbgy/sbgy.xml'
+CACHE_DIR = 'cache'
+CACHE_VERSION = 2
+FANQIE = re.compile('(..)切(?=[一二三四五六七八九十]*$)')
+ANY_FANQIE = re.compile('(..)切')
+
+
+def text_without(element, *tags):
+    '''The text of `element`, leaving out its `tags` children'''
+    return ''.join(chain([element.text or ''],
+                         chain.from_iterable(
+                             ([] if child.tag in tags
+                              else list(child.itertext())) +
+                             [child.tail or ''] for child in element)))
+
+
+def get_tone(volume_title):
+    return re.search('.(?=聲)', ''.join(volume_title.itertext())).group()
+
+
+def get_entry_rime(entry):
+    '''The rhyme named by a rhythmic_entry of a catalog'''
+    return text_without(entry, 'fanqie').strip()[0]
+
+
+def get_rimes(catalog, tone):
+    '''Yields the rimes of a catalog, with eq left empty, and the rhymes
+    each of them is declared tongyong with'''
+    for entry in catalog.iter('rhythmic_entry'):
+        char = get_entry_rime(entry)
+
+        note = entry.find('.//note')
+        eqs = list()
+        duyong = False
+        if note is not None:
+            note = ''.join(note.itertext())  # duyong, tongyong
+            if match := re.search('^.*(?=同用)', note):
+                eqs = list(match.group())
+            duyong = note == '獨用'
+
+        yield Rime(char, tone, None, duyong), eqs
+
+
+def iter_rimes(filename):
+    '''Streams the catalogs of the volumes, then closes the tongyong groups:
+    the eq of a rhyme is the first rhyme of its group'''
+    tone = None
+    rimes = list()
+    links = list()
+    for _, element in ET.iterparse(filename):
+        if element.tag == 'volume_title':
+            tone = get_tone(element)
+        elif element.tag == 'catalog':
+            for rime, eqs in get_rimes(element, tone):
+                rimes.append(rime)
+                links.extend((rime.rime, eq) for eq in eqs)
+            element.clear()
+        elif element.tag == 'voice_part':
+            element.clear()  # the entries of the rhymes are not needed
+
+    eqs = close_tongyong([rime.rime for rime in rimes], links)
+    for rime in rimes:
+        yield rime._replace(eq=eqs.get(rime.rime))
+
+
+def get_rhymes(filename):
+    return {rime.rime: rime for rime in iter_rimes(filename)}
+
+
+# Tongyong groups: the catalog notes link some rhymes together (X同用), and
+# a union-find closes these links into equivalence classes, whatever the
+# order they are declared in
+
+
+def find(parent, i):
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:  # path compression
+        parent[i], i = root, parent[i]
+    return root
+
+
+def union(parent, i, j):
+    '''Merges the classes of i and j; the smallest index stays the root'''
+    i, j = find(parent, i), find(parent, j)
+    if i != j:
+        parent[max(i, j)] = min(i, j)
+
+
+def close_tongyong(rhymes, links):
+    '''Returns rhyme => first rhyme of its class (in the order of `rhymes`),
+    for the rhymes that are not first of their class'''
+    ids = {rhyme: i for i, rhyme in enumerate(rhymes)}
+    parent = list(range(len(rhymes)))
+    for a, b in links:
+        if a in ids and b in ids:
+            union(parent, ids[a], ids[b])
+    return {rhyme: rhymes[find(parent, i)]
+            for i, rhyme in enumerate(rhymes) if find(parent, i) != i}
+
+
+def get_tongyong_classes(sbgy):
+    '''Numbers the rhymes of `sbgy` in order, and maps each rhyme id to the
+    id of the first rhyme of its tongyong class'''
+    rhymes = list(sbgy)
+    ids = {rhyme: i for i, rhyme in enumerate(rhymes)}
+    classes = np.array([ids.get(sbgy[rhyme].eq or rhyme, i)
+                        for i, rhyme in enumerate(rhymes)], dtype=np.int32)
+    return TongyongClasses(rhymes, ids, classes)
+
+
+def map_tongyong(classes, rhyme_ids):
+    '''Maps an array of rhyme ids to the ids of their tongyong classes'''
+    return classes.classes[np.asarray(rhyme_ids)]
+
+
+def get_tongyong_map(sbgy):
+    '''rhyme => first rhyme of its tongyong class, for every rhyme'''
+    classes = get_tongyong_classes(sbgy)
+    ids = map_tongyong(classes, np.arange(len(classes.rhymes)))
+    return {rhyme: classes.rhymes[i]
+            for rhyme, i in zip(classes.rhymes, ids.tolist())}
+
+
+# Compiled cache: the tables are stored as JSON, along with the hash of the
+# XML they were compiled from
+
+
+def get_cache_path(kind):
+    return os.path.join(CACHE_DIR, f'sbgy.{kind}.json')
+
+
+def get_compiled(kind, compile, filename=None):
+    '''Loads the `kind` table compiled from the SBGY, compiling it again with
+    `compile` if the XML changed'''
+    filename = filename or SBGY
+    digest = hash_file(filename)
+    path = get_cache_path(kind)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if (cached['version'], cached['sha1']) == (CACHE_VERSION, digest):
+            return cached['table']
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    table = compile(filename)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(f'{path}.tmp', 'w') as g:
+        json.dump({'version': CACHE_VERSION, 'sha1': digest, 'table': table},
+                  g, ensure_ascii=False)
+    os.replace(f'{path}.tmp', path)
+    return table
+
 
+def load_sbgy(filename=None):
+    rimes = get_compiled('rhymes',
+                         lambda fn: list(map(list, iter_rimes(fn))),
+                         filename)
+    return {rime[0]: Rime(*rime) for rime in rimes}
 
-def iter_volumes(soup):
-    return soup.find_all('volume')
 
+# Pronunciations: every character entry of the rhymes, with the name and tone
+# of its rhyme and the fanqie of its small rhyme (voice_part), in the format
+# of the edoc rows
 
-def get_tone(volume):
-    return re.search('.(?=聲)', volume.find_next('volume_title').text).group()
 
+def get_fanqie(note):
+    '''The fanqie of a small rhyme closes the note of its first character,
+    followed by the number of characters, e.g. 德紅切十七'''
+    note = note.strip()
+    match = FANQIE.search(note) or ANY_FANQIE.search(note)
+    return match.group(1) if match else ''
 
-def get_rhymes(soup):
-    ret = dict()
-    tongyong = dict()
-    for volume in iter_volumes(soup):
-        tone = get_tone(volume)
-        for entry in volume.find_next('catalog').find_all('rhythmic_entry'):
-            entry.find('fanqie').decompose()  # throw away the fanqie
 
-            char = entry.text.strip()[0]
+def iter_readings(filename):
+    '''Yields (char, rhyme, tone, fanqie) for every character entry; each
+    <rhyme> of a volume is named after the entry of the catalog in the same
+    position'''
+    tone, rhymes = None, iter(())
+    rhyme = None
+    for event, element in ET.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'rhyme':
+                rhyme = next(rhymes, None)
+            continue
 
-            note = entry.find('note')
-            eqs = list()
-            duyong = False
-            if note is not None:
-                note = note.extract().text  # duyong, tongyong
-                if match := re.search('^.*(?=同用)', note):
-                    eqs = list(match.group())
-                duyong = note == '獨用'
-            for c in eqs:
-                tongyong[c] = char
+        if element.tag == 'volume_title':
+            tone = get_tone(element)
+        elif element.tag == 'catalog':
+            rhymes = iter([get_entry_rime(entry)
+                           for entry in element.iter('rhythmic_entry')])
+        elif element.tag == 'voice_part':
+            fanqie = None
+            for child in element:
+                if child.tag == 'note' and fanqie is None:
+                    fanqie = get_fanqie(''.join(child.itertext()))
+            for head in element.iter('word_head'):
+                char = ''.join(head.itertext()).strip()
+                if char:
+                    yield char, rhyme, tone, fanqie or ''
+            element.clear()
 
-            ret[char] = Rime(char, tone, tongyong.get(char), duyong)
 
-    return ret
+def compile_pronunciations(filename):
+    ret = defaultdict(list)
+    for char, rhyme, tone, fanqie in iter_readings(filename):
+        ret[char].append({'Graph': char,
+                          'GY Rhyme': rhyme or '',
+                          'GY Tone': tone or '',
+                          'GY fanqie': fanqie,
+                          })
+    return dict(ret)
 
 
-def load_sbgy():
-    with open(SBGY) as f:
-        soup = BeautifulSoup(f, 'html.parser')
-        return get_rhymes(soup)
+def load_sbgy_pronunciations(filename=None):
+    '''Compiles the character entries of the SBGY into char => readings,
+    which can stand in for the edoc pronunciations'''
+    return get_compiled('pronunciations', compile_pronunciations, filename)
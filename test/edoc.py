@@ -0,0 +1,88 @@
+'''A local stand-in for edoc's digitaledoc_linearformat.php, serving tables
+rendered from the rows of the pronunciation cache'''
+import csv
+import threading
+from collections import defaultdict
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+CACHE_FILE = 'cache/pronunciation.cache.csv'
+
+
+def load_rows(filename=CACHE_FILE):
+    ret = defaultdict(list)
+    with open(filename) as f:
+        for row in csv.DictReader(f):
+            ret[row['Graph']].append(row)
+    return ret
+
+
+def render_html(chars, rows):
+    '''Renders the readings of `chars` like edoc does: the result is the third
+    table, and the character is only given on its first reading'''
+    keys = list(next(iter(rows.values()))[0].keys())
+
+    def tr(cells):
+        return '<tr>' + ''.join(f'<td>{escape(c)}</td>' for c in cells) + \
+            '</tr>\n'
+
+    lines = [tr([''] + keys)]
+    for c in chars:
+        for i, row in enumerate(rows.get(c, [])):
+            lines.append(tr([str(len(lines))] +
+                            [row[k] if k != 'Graph' or i == 0 else ''
+                             for k in keys]))
+    return ('<html><body>\n'
+            '<table><tr><td><form></form></td></tr></table>\n'
+            '<table><tr><td>Results</td></tr></table>\n'
+            '<table border="1">\n' + ''.join(lines) + '</table>\n'
+            '</body></html>')
+
+
+class EdocServer:
+    '''Serves the readings of `rows` on a free local port; the first
+    `failures` requests get an HTTP 500'''
+
+    def __init__(self, rows, failures=0):
+        self.rows = rows
+        self.failures = failures
+        self.requests = list()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                form = parse_qs(self.rfile.read(length).decode())
+                chars = form['text_input'][0]
+                with server.lock:
+                    server.requests.append(chars)
+                    fail = server.failures > 0
+                    server.failures -= 1
+                if fail:
+                    self.send_error(500)
+                    return
+                body = render_html(chars, server.rows).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        host, port = self.httpd.server_address
+        self.url = f'http://{host}:{port}/digitaledoc_linearformat.php'
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
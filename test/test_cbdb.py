@@ -1,4 +1,5 @@
 import unittest
+from unittest.mock import patch
 
 from ds import cbdb
 
@@ -45,3 +46,19 @@ class TestFilterByPeriod(unittest.TestCase):
         self.assertTrue(all(p['c_index_year'] is None or
                             p['c_index_year'] in allowed_span
                             for p in persons))
+
+
+class TestLocatePersons(unittest.TestCase):
+    def test_locate_persons(self):
+        persons = [{'x_coord': 118.587, 'y_coord': 24.907},
+                   {'x_coord': None, 'y_coord': None}]
+
+        def get_provinces(*, y, x, type='province'):
+            return [f'{type} {x}' if x else None for x in x]
+
+        with patch.object(cbdb, 'get_provinces', wraps=get_provinces) as g:
+            cbdb.locate_persons(persons)
+        self.assertEqual(2, g.call_count)  # one batch per type
+        self.assertEqual('province 118.587', persons[0]['province'])
+        self.assertEqual('prefecture 118.587', persons[0]['prefecture'])
+        self.assertIsNone(persons[1]['province'])
@@ -2,6 +2,7 @@ import unittest
 from collections import Counter
 
 from ds import community
+from ds.graph import Node
 
 
 class TestAlignCommunities(unittest.TestCase):
@@ -50,3 +51,12 @@ class TestGetTopMissing(unittest.TestCase):
         # of which no character is missing in A
         self.assertEquals(set(),
                           community.get_top_missing(comm_b, comm_a))
+
+
+class TestCommunityIndex(unittest.TestCase):
+    def test_build_community_index(self):
+        comms = [frozenset({Node('深', '侵'), Node('心', '侵'),
+                            Node('簪', '侵')}),
+                 frozenset({Node('簪', '覃'), Node('南', '覃')})]
+        self.assertEqual({'深': (0,), '心': (0,), '簪': (0, 1), '南': (1,)},
+                         community.build_community_index(comms))
@@ -1,7 +1,11 @@
+import json
+import os
 import tempfile
+import types
 import unittest
 
-from ds import authors, corpus
+from ds import authors, corpus, graph, poem
+from ds.sbgy import Rime
 
 authors.AUTHORS = {'qts': 'test/authors.tang.json'}
 
@@ -53,3 +57,154 @@ class TestCorpus(unittest.TestCase):
         self.assertNotEqual(0, len(oyz_hy))
         self.assertTrue(poem['author'] == '歐陽詹' or poem['author'] == '韓愈'
                         for poem in oyz_hy)
+
+
+class TestCorpusFiles(unittest.TestCase):
+    def setUp(self):
+        self.original_corpora = corpus.CORPORA
+        self.original_snapshot_dir = corpus.SNAPSHOT_DIR
+        self.tmp = tempfile.TemporaryDirectory()
+        prefix = os.path.join(self.tmp.name, 'poet.tang')
+        corpus.CORPORA = {'qts': prefix}
+        corpus.SNAPSHOT_DIR = self.tmp.name
+        shards = {0: [{'author': '杜甫', 'title': '春望', 'id': 'a',
+                       'paragraphs': ['國破山河在，城春草木深。',
+                                      '（一作）', '',
+                                      '[感]時花濺淚，恨別鳥驚心。']}],
+                  1000: [{'author': '韓愈', 'title': '', 'id': 'c',
+                          'paragraphs': ['草色遙看近卻無。']}],
+                  2: [{'author': '歐陽詹', 'title': '', 'id': 'b',
+                       'paragraphs': ['天街小雨潤如酥，']},
+                      {'author': '無名氏', 'paragraphs': [],
+                       'strains': ['平平仄仄']}],
+                  }
+        for n, poems in shards.items():
+            with open(f'{prefix}.{n}.json', 'w') as g:
+                json.dump(poems, g, ensure_ascii=False)
+
+    def tearDown(self):
+        corpus.CORPORA = self.original_corpora
+        corpus.SNAPSHOT_DIR = self.original_snapshot_dir
+        self.tmp.cleanup()
+
+    def test_iter_corpus(self):
+        stream = corpus.iter_corpus('qts')
+        self.assertIsInstance(stream, types.GeneratorType)
+        poems = list(stream)
+        self.assertEqual(['a', 'b', None, 'c'],
+                         [poem.get('id') for poem in poems])
+        self.assertEqual(['國破山河在，城春草木深。', '感時花濺淚，恨別鳥驚心。'],
+                         poems[0]['paragraphs'])
+        self.assertEqual(corpus.get_corpus('qts', snapshot=False), poems)
+
+    def test_get_corpus_parallel(self):
+        self.assertEqual(corpus.get_corpus('qts', snapshot=False),
+                         corpus.get_corpus('qts', workers=2, snapshot=False))
+
+    def test_snapshot(self):
+        self.assertFalse(corpus.is_snapshot_fresh('qts'))
+        self.assertEqual(corpus.get_corpus('qts', snapshot=False),
+                         corpus.get_corpus('qts', snapshot=True))
+        self.assertTrue(corpus.is_snapshot_fresh('qts'))
+        self.assertEqual(corpus.get_corpus('qts', snapshot=False),
+                         corpus.load_snapshot('qts'))
+
+    def test_no_snapshot_by_default(self):
+        corpus.get_corpus('qts')
+        self.assertFalse(os.path.exists(corpus.get_snapshot_path('qts')))
+
+    def test_lazy_snapshot(self):
+        qts = corpus.get_corpus('qts', snapshot=True)
+        self.assertEqual([None] * 4, qts.poems)
+        self.assertEqual({'id': 'b', 'author': '歐陽詹', 'title': '',
+                          'paragraphs': ['天街小雨潤如酥，']},
+                         qts.get_poem('b'))
+        self.assertEqual(['a', 'b', None, 'c'], qts.get_column('id'))
+        self.assertEqual([None, qts[1], None, None], qts.poems)
+        self.assertIs(qts[1], qts.get_poem('b'))
+        self.assertEqual(['平平仄仄'], qts[-2]['strains'])
+
+    def test_snapshot_arrays(self):
+        qts = corpus.get_corpus('qts', snapshot=True)
+        qts.append({'id': 'd', 'paragraphs': ['國破山河在，']})
+        expected = poem.encode_poems(list(corpus.get_corpus('qts')) +
+                                     [qts[-1]])
+        for actual, array in zip(qts.encode(), expected):
+            self.assertEqual(array.tolist(), actual.tolist())
+        records = list(qts.iter_records())
+        self.assertEqual([None] * 4, qts.poems[:4])
+        self.assertEqual(list(qts), records)
+
+    def test_extend_snapshot(self):
+        qts = corpus.Corpus([{'id': 'z'}], collection='qss')
+        qts.extend(corpus.get_corpus('qts', snapshot=True))
+        self.assertEqual('a', qts[1]['id'])
+        self.assertEqual(qts[1:], qts.select('collection', {'qts'}))
+        self.assertEqual(['z', 'a', 'b', None, 'c'], qts.get_column('id'))
+
+    def test_snapshot_invalidation(self):
+        corpus.get_corpus('qts', snapshot=True)
+        filename = corpus.get_files('qts')[0]
+
+        # same content, new mtime: the snapshot is still valid
+        os.utime(filename, ns=(0, 0))
+        self.assertTrue(corpus.is_snapshot_fresh('qts'))
+        self.assertTrue(corpus.is_snapshot_fresh('qts'))
+
+        with open(filename, 'w') as g:
+            json.dump([{'author': '李白', 'title': '', 'id': 'z',
+                        'paragraphs': ['床前明月光，']}], g)
+        self.assertFalse(corpus.is_snapshot_fresh('qts'))
+        self.assertEqual('李白',
+                         corpus.get_corpus('qts', snapshot=True)[0]['author'])
+
+    def test_graph_from_stream(self):
+        prons = {'深': [{'GY Rhyme': '侵'}], '心': [{'GY Rhyme': '侵'}]}
+        context = poem.PoemContext(prons, {'侵': Rime('侵', '平', None)})
+        gph = graph.build_graph(corpus.iter_corpus('qts', context=context))
+        self.assertEqual(4, len(gph.nodes))
+        self.assertTrue(gph.has_edge(graph.Node('深', '侵'),
+                                     graph.Node('心', '侵')))
+
+    def test_filter_stream_by_authors(self):
+        oyz_hy = corpus.filter_by_authors({'歐陽詹', '韓愈'},
+                                          corpus.iter_corpus('qts'))
+        self.assertNotIsInstance(oyz_hy, list)
+        self.assertEqual(['b', 'c'], [poem['id'] for poem in oyz_hy])
+
+
+class TestCorpusIndexes(unittest.TestCase):
+    def setUp(self):
+        self.qts = corpus.Corpus([{'id': 'a', 'author': '杜甫'},
+                                  {'id': 'b', 'author': '韓愈'},
+                                  {'id': 'c', 'author': '杜甫'}],
+                                 collection='qts')
+        self.corpus = corpus.Corpus()
+        self.corpus.extend(self.qts)
+        self.corpus.extend([{'id': 'd', 'author': '蘇軾'}], collection='qss')
+
+    def test_sequence(self):
+        self.assertEqual(4, len(self.corpus))
+        self.assertEqual('d', self.corpus[-1]['id'])
+        self.assertEqual(['qts'] * 3 + ['qss'], self.corpus.collections)
+
+    def test_select(self):
+        self.assertEqual([self.qts[0], self.qts[2]],
+                         self.corpus.select('id', ['c', 'a', 'z']))
+        self.assertEqual([self.corpus[3]],
+                         self.corpus.select('collection', {'qss'}))
+        self.assertEqual({'id': 'b', 'author': '韓愈'},
+                         self.corpus.get_poem('b'))
+        self.assertIsNone(self.corpus.get_poem('z'))
+
+    def test_indexes_are_refreshed(self):
+        self.assertEqual([], self.corpus.select('author', {'李白'}))
+        self.corpus.append({'id': 'e', 'author': '李白'})
+        self.assertEqual(['e'], [poem['id'] for poem
+                                 in self.corpus.select('author', {'李白'})])
+
+    def test_filter_by_authors(self):
+        self.assertEqual(['a', 'c', 'd'],
+                         [poem['id'] for poem in
+                          corpus.filter_by_authors({'杜甫', '蘇軾'},
+                                                   self.corpus)])
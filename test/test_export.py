@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+from ds import export
+from ds.corpus import Corpus
+from ds.graph import Node
+from ds.poem import Poem
+from ds.sbgy import Rime
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.prons = {
+            '深': [{'GY Rhyme': '侵'}, {'GY Rhyme': '沁'}],
+            '心': [{'GY Rhyme': '侵'}],
+            '金': [{'GY Rhyme': '侵'}],
+            '簪': [{'GY Rhyme': '侵'}, {'GY Rhyme': '覃'}],
+        }
+        self.sbgy = {'侵': Rime('侵', '平', None),
+                     '覃': Rime('覃', '平', None)}
+        self.communities = [frozenset({Node('深', '侵'), Node('心', '侵')}),
+                            frozenset({Node('金', '侵'), Node('簪', '侵')})]
+        lines = ['國破山河在，城春草木深。', '感時花濺淚，恨別鳥驚心。',
+                 '烽火連三月，家書抵萬金。', '白頭搔更短，渾欲不勝簪。']
+        self.poems = [Poem(id=str(i), paragraphs=lines[i % 4:])
+                      for i in range(10)]
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, 'annotations.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def export(self, poems):
+        return export.export_annotations(poems, self.filename,
+                                         self.prons, self.sbgy,
+                                         communities=self.communities,
+                                         apply_tongyong=True, workers=2,
+                                         shard_size=3)
+
+    def test_export_annotations(self):
+        self.assertEqual(10, self.export(self.poems))
+        records = export.load_annotations(self.filename)
+        self.assertEqual([str(i) for i in range(10)],
+                         [record['id'] for record in records])
+        for record, poem in zip(records, self.poems):
+            poem = Poem(poem, prons=self.prons, sbgy=self.sbgy)
+            self.assertEqual(poem.annotate_on_category(True),
+                             record['category'])
+            self.assertEqual(poem.annotate_on_community(self.communities),
+                             record['community'])
+        self.assertNotIn('prons', records[0])
+
+    def test_resume(self):
+        self.export(self.poems[:4])
+        with open(self.filename, 'a') as g:
+            g.write('{"id": "4", "paragr')  # interrupted while writing
+
+        self.assertEqual(10, self.export(self.poems))
+        self.assertEqual([str(i) for i in range(10)],
+                         [record['id'] for record
+                          in export.load_annotations(self.filename)])
+
+    def test_export_corpus(self):
+        self.assertEqual(10, self.export(Corpus(self.poems)))
+        self.assertEqual([str(i) for i in range(10)],
+                         [record['id'] for record
+                          in export.load_annotations(self.filename)])
@@ -1,4 +1,10 @@
+import random
 import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+from shapely.geometry import Point, box
 
 from ds import gis
 
@@ -17,3 +23,79 @@ class TestGis(unittest.TestCase):
                                ]:
             self.assertEquals(province, gis.get_province(x=x, y=y,
                                                          type='prefecture'))
+
+    def test_lazy_loading(self):
+        with patch.object(gis, 'readers', dict()), \
+                patch.object(gis, 'get_transformer'), \
+                patch.object(gis, 'load_reader') as load_reader:
+            self.assertIsNone(gis.get_province(x=None, y=None))
+            load_reader.assert_not_called()
+            gis.preload()
+            gis.preload()
+            self.assertEqual(2, load_reader.call_count)
+            self.assertEqual({'province', 'prefecture'}, set(gis.readers))
+
+
+class Record(dict):
+    def as_dict(self):
+        return dict(self)
+
+
+class TestGisIndex(unittest.TestCase):
+    def setUp(self):
+        # overlapping boxes, so that the order of the shapefile matters
+        random.seed(0)
+        provinces = list()
+        for i in range(200):
+            x, y = random.uniform(0, 100), random.uniform(0, 100)
+            provinces.append(SimpleNamespace(
+                sh=box(x, y, x + random.uniform(1, 20),
+                       y + random.uniform(1, 20)),
+                record=Record(NAME_HZ=str(i))))
+        self.reader = gis.index_reader(SimpleNamespace(provinces=provinces))
+
+    def test_find_province(self):
+        points = [Point(random.uniform(-10, 130), random.uniform(-10, 130))
+                  for _ in range(2000)]
+        # on the edges and corners
+        points += [Point(p.sh.bounds[:2]) for p in self.reader.provinces]
+        points += [Point(p.sh.bounds[0], p.sh.centroid.y)
+                   for p in self.reader.provinces]
+        for point in points:
+            self.assertIs(gis.find_province_linear(self.reader, point),
+                          gis.find_province(self.reader, point))
+
+    def test_find_provinces(self):
+        points = [(random.uniform(-10, 130), random.uniform(-10, 130))
+                  for _ in range(500)]
+        points += [p.sh.bounds[:2] for p in self.reader.provinces]
+        expected = [self.reader.provinces.index(province)
+                    if province is not None else -1
+                    for province in (gis.find_province_linear(self.reader,
+                                                              Point(*point))
+                                     for point in points)]
+        px, py = map(np.array, zip(*points))
+        self.assertEqual(expected,
+                         gis.find_provinces(self.reader, px, py).tolist())
+        with patch.object(gis, 'SWEEP_POINTS', 0):
+            self.assertEqual(expected,
+                             gis.find_provinces(self.reader, px, py).tolist())
+
+    def test_get_province(self):
+        with patch.object(gis, 'readers', {'province': self.reader}):
+            province = self.reader.provinces[7]
+            y, x = province.sh.representative_point().coords[0]
+            self.assertEqual(gis.get_name(gis.find_province_linear(
+                self.reader, Point(y, x))), gis.get_province(x=x, y=y))
+            self.assertIsNone(gis.get_province(x=500, y=500))
+
+    def test_get_provinces(self):
+        ys = [random.uniform(-10, 130) for _ in range(2000)] + [5, 5, 5]
+        xs = [random.uniform(-10, 130) for _ in range(2000)] + [None, 0, 5]
+        with patch.object(gis, 'readers', {'province': self.reader}):
+            expected = [gis.get_province(x=x, y=y) for x, y in zip(xs, ys)]
+            self.assertEqual(expected, gis.get_provinces(x=xs, y=ys))
+            with patch.object(gis, 'contains_xy', None):
+                self.assertEqual(expected, gis.get_provinces(x=xs, y=ys))
+        self.assertEqual([None, None], gis.get_provinces(x=[None, 0],
+                                                         y=[1, 2]))
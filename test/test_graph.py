@@ -1,10 +1,11 @@
 import unittest
 from collections import Counter
-from operator import itemgetter
+from operator import itemgetter, methodcaller
+from unittest.mock import patch
 
 from flaky import flaky
 
-from ds import graph
+from ds import graph, poem
 from ds.poem import Poem
 
 
@@ -42,6 +43,27 @@ class TestGraph(unittest.TestCase):
         self.assertEquals(p_nodes + p_nodes, nodes)
         self.assertEquals(p_edges + p_edges, edges)
 
+    def test_precomputed_rhymes(self):
+        poems = [Poem({'paragraphs': self.poem['paragraphs'],
+                       'prons': self.prons, 'sbgy': {}}) for _ in range(5)]
+        rhymes = poem.get_corpus_rhymes(poem.encode_poems(poems))
+        with patch.object(poem, 'find_rhymes',
+                          wraps=poem.find_rhymes) as find_rhymes:
+            nodes, _ = graph.build_python_graph(
+                poems, methodcaller('get_naive_annotations'), rhymes)
+        find_rhymes.assert_not_called()  # not even by the annotator
+        self.assertEqual(20, sum(nodes.values()))
+
+    def test_precomputed_rhymes_are_not_kept(self):
+        p = Poem({'paragraphs': ['日出東，何處先。'],
+                  'prons': self.prons, 'sbgy': {}})
+        expected = p.annotate_on_category()
+        rhymes = poem.get_corpus_rhymes(poem.encode_poems([p]), split=True)
+        graph.build_python_graph([p], methodcaller('get_naive_annotations'),
+                                 rhymes)
+        self.assertEqual(['先'], p.get_rhymes())
+        self.assertEqual(expected, p.annotate_on_category())
+
     def test_py2nx(self):
         nodes, edges = graph.build_single_poem_graph(self.poem)
         gph = graph.py2nx(nodes, edges)
@@ -1,4 +1,5 @@
 import unittest
+from collections import OrderedDict
 
 from ds import helpers
 
@@ -26,6 +27,20 @@ class TestWindow(unittest.TestCase):
                          helpers.window_combinations('abcde', len('abcde')))
 
 
+class TestFilterConstraint(unittest.TestCase):
+    def test_filter_constraint(self):
+        dicts = [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}, {'a': 3, 'b': 'x'}]
+        self.assertEqual([{'a': 3, 'b': 'x'}],
+                         helpers.filter_constraint({'a': (2).__lt__,
+                                                    'b': 'x'.__eq__},
+                                                   dicts))
+
+    def test_ifilter_constraint_is_lazy(self):
+        it = helpers.ifilter_constraint({'a': (1).__lt__},
+                                        iter([{'a': 1}, {'a': 2}]))
+        self.assertEqual({'a': 2}, next(it))
+
+
 class TestPrecision(unittest.TestCase):
     def test_get_precision_vector(self):
         relevant = ['a', 'b', 'c', 'd', 'e', 'f']
@@ -76,3 +91,22 @@ class TestTakewhileCdf(unittest.TestCase):
                            {'a': 10, 'b': 1},  # 11% > 96%
                            ],
                           list(helpers.takewhile_cdf(dict_lst, cdf=0.96)))
+
+
+class TestCachedById(unittest.TestCase):
+    def test_get_cached_by_id(self):
+        cache = OrderedDict()
+        a, b, c = [1], [1], [1]
+        built = list()
+
+        def build(obj):
+            built.append(obj)
+            return len(built)
+
+        self.assertEqual(1, helpers.get_cached_by_id(cache, 2, build, a))
+        self.assertEqual(2, helpers.get_cached_by_id(cache, 2, build, b))
+        self.assertEqual(1, helpers.get_cached_by_id(cache, 2, build, a))
+        self.assertEqual(3, helpers.get_cached_by_id(cache, 2, build, c))
+        # b was the least recently used
+        self.assertEqual(4, helpers.get_cached_by_id(cache, 2, build, b))
+        self.assertEqual(2, len(cache))
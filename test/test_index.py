@@ -0,0 +1,192 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ds import corpus, index
+from ds.corpus import Corpus
+from ds.poem import Poem, PoemContext
+
+
+class TestRhymePairIndex(unittest.TestCase):
+    def setUp(self):
+        prons = {
+            '先': [{'GY Rhyme': '先'}],
+            '篇': [{'GY Rhyme': '仙'}],
+            '千': [{'GY Rhyme': '先'}],
+            '源': [{'GY Rhyme': '元'}],
+            '東': [{'GY Rhyme': '東'}],
+            '冬': [{'GY Rhyme': '冬'}],
+        }
+        self.poems = Corpus([
+            Poem(id='a', prons=prons,
+                 paragraphs=['風雅不墜地，五言始君先。',
+                             '希微嘉會章，杳冥河梁篇。',
+                             '理蔓語無枝，言一意則千。',
+                             '往來更後人，澆蕩醨前源。']),
+            Poem(id='b', prons=prons, paragraphs=['日出東，', '又一冬。']),
+            Poem(id='c', prons=prons, paragraphs=['日出東，', '何處先。',
+                                                  '又一冬。']),
+            Poem(prons=prons, paragraphs=['春在東，', '夜已冬。']),
+        ])
+
+    def test_query(self):
+        idx = index.build_rhyme_pair_index(self.poems)
+        self.assertEqual({0}, index.query_rhyme_pair_index(idx,
+                                                           ('仙先文', '元')))
+        self.assertEqual({1, 3}, index.query_rhyme_pair_index(idx,
+                                                              ('東', '冬')))
+        self.assertEqual({1, 3}, index.query_rhyme_pair_index(idx,
+                                                              ('冬', '東')))
+        self.assertEqual(set(), index.query_rhyme_pair_index(idx,
+                                                             ('東', '元')))
+
+    def test_matches_find_rhyme_pairs(self):
+        idx = index.build_rhyme_pair_index(self.poems)
+        for pair in [('仙先文', '元'), ('東', '冬'), ('先', '東冬'),
+                     ('先', '仙')]:
+            self.assertEqual({i for i, poem in enumerate(self.poems)
+                              if poem.find_rhyme_pairs(pair)},
+                             index.query_rhyme_pair_index(idx, pair))
+
+    def test_corpus_index(self):
+        idx = index.get_corpus_rhyme_pair_index(self.poems)
+        self.assertIs(idx, index.get_corpus_rhyme_pair_index(self.poems))
+
+    def test_corpus_index_follows_context(self):
+        index.get_corpus_rhyme_pair_index(self.poems)
+        self.poems.set_context(PoemContext({'東': [{'GY Rhyme': '陽'}],
+                                            '冬': [{'GY Rhyme': '陽'}]}))
+        self.assertEqual(set(), index.query_rhyme_pair_index(
+            index.get_corpus_rhyme_pair_index(self.poems), ('東', '冬')))
+        self.assertEqual(set(), self.poems[1].find_rhyme_pairs(('東', '冬')))
+
+
+class TestNgramIndex(unittest.TestCase):
+    def setUp(self):
+        self.poems = Corpus([Poem(id='a', author='杜甫',
+                                  paragraphs=['國破山河在，城春草木深。',
+                                              '感時花濺淚，恨別鳥驚心。']),
+                             Poem(id='b', author='李白',
+                                  paragraphs=['床前明月光，', '疑是地上霜。',
+                                              '舉頭望明月，', '低頭思故鄉。'])],
+                            collection='qts')
+        self.poems.extend([Poem(author='蘇軾',
+                                paragraphs=['明月幾時有，把酒問青天。'])],
+                          collection='qsc')
+        self.index = index.build_ngram_index(self.poems)
+
+    def test_search(self):
+        self.assertEqual([('a', 0, 2)], index.search(self.index, '山'))
+        self.assertEqual([('b', 0, 2), ('b', 2, 3), (None, 0, 0)],
+                         index.search(self.index, '明月'))
+        self.assertEqual([('b', 2, 2)], index.search(self.index, '望明月'))
+        self.assertEqual([], index.search(self.index, '月明'))
+        self.assertEqual([], index.search(self.index, '水'))
+
+    def test_phrase_does_not_span_lines(self):
+        self.assertEqual([], index.search(self.index, '光疑'))
+        self.assertEqual([], index.search(self.index, '，疑是'))
+
+    def test_search_all(self):
+        self.assertEqual([('b', 2)],
+                         index.search_all(self.index, ['明月', '頭']))
+        self.assertEqual([('b', 2), ('b', 3)],
+                         index.search_all(self.index, ['頭']))
+
+    def test_concordance(self):
+        kwic = index.concordance(self.index, self.poems, '明月', width=2)
+        self.assertEqual(['床前', '頭望', ''], [k['left'] for k in kwic])
+        self.assertEqual(['光，', '，', '幾時'], [k['right'] for k in kwic])
+        self.assertEqual(['李白', '李白', '蘇軾'], [k['author'] for k in kwic])
+        self.assertEqual(['qts', 'qts', 'qsc'],
+                         [k['collection'] for k in kwic])
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'ngrams.npz')
+            index.save_ngram_index(self.index, filename)
+            loaded = index.load_ngram_index(filename)
+        self.assertEqual(index.search(self.index, '明月'),
+                         index.search(loaded, '明月'))
+
+
+class TestStoredIndexes(unittest.TestCase):
+    def setUp(self):
+        self.original_corpora = corpus.CORPORA
+        self.original_snapshot_dir = corpus.SNAPSHOT_DIR
+        self.tmp = tempfile.TemporaryDirectory()
+        self.shard = os.path.join(self.tmp.name, 'poet.tang.0.json')
+        corpus.CORPORA = {'qts': os.path.join(self.tmp.name, 'poet.tang')}
+        corpus.SNAPSHOT_DIR = self.tmp.name
+        self.write([{'id': 'a', 'paragraphs': ['床前明月光，', '疑是地上霜。']},
+                    {'id': 'b', 'paragraphs': ['明月幾時有，']}])
+
+    def tearDown(self):
+        corpus.CORPORA = self.original_corpora
+        corpus.SNAPSHOT_DIR = self.original_snapshot_dir
+        self.tmp.cleanup()
+
+    def write(self, poems):
+        with open(self.shard, 'w') as g:
+            json.dump(poems, g, ensure_ascii=False)
+
+    def get_ngram_index(self, poems):
+        with patch.object(index, 'build_ngram_index',
+                          wraps=index.build_ngram_index) as build:
+            ret = index.get_ngram_index('qts', poems)
+        return ret, build.called
+
+    def test_ngram_index(self):
+        qts = corpus.get_corpus('qts', snapshot=True)
+        stored, built = self.get_ngram_index(qts)
+        self.assertTrue(built)
+        loaded, built = self.get_ngram_index(qts)
+        self.assertFalse(built)
+        self.assertEqual(index.search(stored, '明月'),
+                         index.search(loaded, '明月'))
+
+    def test_ngram_index_of_other_poems(self):
+        qts = corpus.get_corpus('qts', snapshot=True)
+        self.get_ngram_index(qts)
+
+        subset, built = self.get_ngram_index(qts[1:])
+        self.assertTrue(built)
+        self.assertEqual([('b', 0, 0)], index.search(subset, '明月'))
+
+        self.write([{'id': 'c', 'paragraphs': ['明月出天山，']},
+                    {'id': 'd', 'paragraphs': ['海上生明月，']}])
+        changed, built = self.get_ngram_index(corpus.get_corpus('qts'))
+        self.assertTrue(built)
+        self.assertEqual(['c', 'd'], [id for id, _, _
+                                      in index.search(changed, '明月')])
+
+    def get_rhyme_pair_index(self, poems, prons):
+        poems.set_context(PoemContext(prons))
+        with patch.object(index, 'build_rhyme_pair_index',
+                          wraps=index.build_rhyme_pair_index) as build:
+            ret = index.get_rhyme_pair_index('qts', poems, prons)
+        return ret, build.called
+
+    def test_rhyme_pair_index(self):
+        qts = corpus.get_corpus('qts', snapshot=True)
+        prons = {'光': [{'GY Rhyme': '唐'}], '霜': [{'GY Rhyme': '陽'}]}
+        stored, built = self.get_rhyme_pair_index(qts, prons)
+        self.assertTrue(built)
+        self.assertEqual({0}, index.query_rhyme_pair_index(stored,
+                                                           ('唐', '陽')))
+        loaded, built = self.get_rhyme_pair_index(qts, prons)
+        self.assertFalse(built)
+        self.assertEqual(stored, loaded)
+
+        # other pronunciations, e.g. from another backend
+        prons = {'光': [{'GY Rhyme': '唐'}], '霜': [{'GY Rhyme': '唐'}]}
+        changed, built = self.get_rhyme_pair_index(qts, prons)
+        self.assertTrue(built)
+        self.assertEqual(set(), index.query_rhyme_pair_index(changed,
+                                                             ('唐', '陽')))
+        self.assertEqual((index.get_rhyme_signature(prons), changed),
+                         index.load_rhyme_pair_index(os.path.join(
+                             corpus.get_snapshot_path('qts'),
+                             index.RHYME_PAIR_INDEX)))
@@ -1,6 +1,9 @@
+import pickle
+import sys
 import unittest
 
 from ds import poem
+from ds.graph import Node
 
 
 class TestPoem(unittest.TestCase):
@@ -24,6 +27,47 @@ class TestPoem(unittest.TestCase):
         self.assertEquals('杜甫', p['author'])
         self.assertEquals('春望', p['title'])
 
+    def test_poem_mapping(self):
+        p = poem.Poem({'paragraphs': self.poem, 'id': 'x'}, tags=['五言'])
+        self.assertEqual({'paragraphs': self.poem, 'id': 'x',
+                          'tags': ['五言']}, dict(p))
+        self.assertEqual(3, len(p))
+        self.assertNotIn('author', p)
+        self.assertIsNone(p.get('author'))
+        del p['tags']
+        self.assertEqual({'paragraphs', 'id'}, set(p))
+
+    def test_shared_context(self):
+        context = poem.PoemContext(prons=self.prons)
+        p1 = poem.Poem(paragraphs=self.poem, context=context)
+        p2 = poem.Poem(paragraphs=self.poem, context=context)
+        self.assertIs(p1['prons'], p2['prons'])
+        self.assertNotIn('prons', dict(p1))
+
+        # setting a table on a single poem does not affect the others
+        p1['prons'] = {}
+        self.assertEqual({}, p1['prons'])
+        self.assertIs(self.prons, p2['prons'])
+        self.assertIsNot(p1.context, p2.context)
+
+    def test_pickle(self):
+        context = poem.PoemContext(prons=self.prons)
+        poems = [poem.Poem(paragraphs=self.poem, author='杜甫',
+                           context=context)
+                 for _ in range(3)]
+        unpickled = pickle.loads(pickle.dumps(poems))
+        self.assertEqual(poems, unpickled)
+        self.assertIs(unpickled[0].context, unpickled[2].context)
+        self.assertEqual(self.prons, unpickled[1]['prons'])
+
+    def test_compact(self):
+        p = poem.Poem(paragraphs=self.poem, author='杜甫', title='春望',
+                      id='x')
+        self.assertLess(sys.getsizeof(p),
+                        sys.getsizeof({'paragraphs': self.poem,
+                                       'author': '杜甫', 'title': '春望',
+                                       'id': 'x'}))
+
     def test_get_rhymes(self):
         p = poem.Poem(paragraphs=self.poem)
         self.assertEquals(['深', '心', '金', '簪'], p.get_rhymes())
@@ -33,6 +77,87 @@ class TestPoem(unittest.TestCase):
         self.assertEquals(['侵', '侵', '侵', '侵'],
                           p.get_rhyme_categories())
 
+    def test_get_rhyme_categories_precomputed(self):
+        p = poem.Poem(paragraphs=self.poem, prons=self.prons)
+        self.assertEqual(['侵', '侵'],
+                         p.get_rhyme_categories(rhymes=['深', '簪']))
+
+    def test_get_rhyme_categories_batch(self):
+        prons = {**self.prons,
+                 '長': [{'GY Rhyme': '陽'},
+                       {'GY Rhyme': '漾'},
+                       {'GY Rhyme': '養'}],
+                 '章': [{'GY Rhyme': '陽'}],
+                 '向': [{'GY Rhyme': '漾'}, {'GY Rhyme': '陽'}]}
+        poems = [poem.Poem(paragraphs=self.poem, prons=prons),
+                 poem.Poem(paragraphs=['日月長，', '文章。', '何所向？'],
+                           prons=prons),
+                 poem.Poem(paragraphs=['無韻'], prons=prons)]
+        self.assertEqual([['侵', '侵', '侵', '侵'], ['陽', '陽', '陽'], []],
+                         poem.get_rhyme_categories_batch(poems))
+        self.assertEqual([p.get_rhyme_categories() for p in poems],
+                         poem.get_rhyme_categories_batch(poems))
+
+    def test_disambiguate_masks(self):
+        a, b, c = (poem.get_rhyme_mask(r) for r in ('a', 'b', 'c'))
+        self.assertEqual([a, a, c, c, a | c, a],
+                         poem.disambiguate_masks([a, a | b, c, b | c, a | c,
+                                                  a | b]))
+        self.assertEqual('?', poem.get_category(0))
+        self.assertEqual('abc', poem.get_category(c | b | a))
+
+    def test_annotate_on_community(self):
+        comms = [frozenset({Node('深', '侵'), Node('心', '侵'),
+                            Node('簪', '侵')}),
+                 frozenset({Node('金', '侵'), Node('簪', '覃')})]
+        poems = [poem.Poem(paragraphs=self.poem),
+                 poem.Poem(paragraphs=self.poem[2:]),
+                 poem.Poem(paragraphs=['無韻'])]
+        self.assertEqual(['國破山河在，城春草木[a]深。',
+                          '感時花濺淚，恨別鳥驚[a]心。',
+                          '烽火連三月，家書抵萬[b]金。',
+                          '白頭搔更短，渾欲不勝[a]簪。'],
+                         poems[0].annotate_on_community(comms))
+        self.assertEqual([1, 1], poems[1].get_rhyme_communities(comms))
+        self.assertEqual([p.annotate_on_community(comms) for p in poems],
+                         poem.annotate_on_community(poems, comms))
+
+    def test_community_cache(self):
+        comms = [frozenset({Node('深', '侵'), Node('心', '侵')}),
+                 frozenset({Node('金', '侵'), Node('簪', '覃')})]
+        p = poem.Poem(paragraphs=self.poem)
+        poem.reset_cache_stats()
+        self.assertEqual([0, 0, 1, 1], p.get_rhyme_communities(comms))
+        self.assertEqual([0, 0, 1, 1], p.get_rhyme_communities(comms))
+        # the cache holds a token, not a copy of the communities
+        (key,) = [key for key in p.cache[1] if key[0] == 'communities']
+        self.assertEqual(2, len(key))
+        self.assertNotIn(comms[0], key)
+        self.assertEqual(1, poem.get_cache_stats()['hits'])
+
+    def test_cache(self):
+        context = poem.PoemContext(prons=self.prons)
+        p = poem.Poem(paragraphs=self.poem, context=context)
+        poem.reset_cache_stats()
+
+        self.assertEqual(['侵', '侵', '侵', '侵'], p.get_rhyme_categories())
+        self.assertEqual(['深', '心', '金', '簪'], p.get_rhymes())
+        self.assertEqual(['a', 'a', 'a', 'a'], p.get_naive_annotations())
+        self.assertEqual({'misses': 2, 'hits': 2}, poem.get_cache_stats())
+
+        # changing the paragraphs or the tables invalidates the cache
+        p['paragraphs'] = self.poem[:2]
+        self.assertEqual(['深', '心'], p.get_rhymes())
+        context.prons = {'深': [{'GY Rhyme': '沁'}],
+                         '心': [{'GY Rhyme': '侵'}]}
+        self.assertEqual(['沁', '侵'], p.get_rhyme_categories())
+        self.assertEqual({'misses': 5, 'hits': 2}, poem.get_cache_stats())
+
+    def test_cache_is_not_pickled(self):
+        p = poem.Poem(paragraphs=self.poem)
+        p.get_rhymes()
+        self.assertIsNone(pickle.loads(pickle.dumps(p)).cache)
+
     def test_find_rhyme_pairs(self):
         prons = {
             '先': [{'GY Rhyme': '先'}],
@@ -50,3 +175,32 @@ class TestPoem(unittest.TestCase):
 
         self.assertEquals({('元', '先'), },
                           p.find_rhyme_pairs(('仙先文', '元')))
+
+
+class TestCorpusRhymes(unittest.TestCase):
+    def setUp(self):
+        self.poems = [
+            poem.Poem(paragraphs=["國破山河在，城春草木深。",
+                                  "感時花濺淚，恨別鳥驚心。"]),
+            poem.Poem(paragraphs=[]),
+            poem.Poem(paragraphs=["", "無韻", "」。", "（某）詩。」",
+                                  "白頭[搔]更短，渾欲不勝簪？"]),
+        ]
+
+    def test_encode_poems(self):
+        encoded = poem.encode_poems(self.poems)
+        self.assertEqual([0, 2, 2, 7], encoded.poem_offsets.tolist())
+        self.assertEqual(len(encoded.codes), encoded.line_offsets[-1])
+        self.assertEqual(ord('國'), encoded.codes[0])
+
+    def test_get_corpus_rhymes(self):
+        encoded = poem.encode_poems(self.poems)
+        for split in (False, True):
+            self.assertEqual([p.get_rhymes(split=split) for p in self.poems],
+                             poem.get_corpus_rhymes(encoded, split=split))
+
+    def test_get_rhyme_positions(self):
+        encoded = poem.encode_poems(self.poems[:1])
+        positions, lines = poem.get_rhyme_positions(encoded)
+        self.assertEqual([10, 22], positions.tolist())
+        self.assertEqual([0, 1], lines.tolist())
@@ -1,18 +1,29 @@
+import csv
 import os
+import pickle
 import tempfile
 import unittest
+from time import monotonic
+
+import requests
 
 from ds import pronunciation
+from ds.sbgy import Rime
+from test.edoc import EdocServer, load_rows, render_html
 
 
 class TestPronunciation(unittest.TestCase):
     def setUp(self):
         with tempfile.NamedTemporaryFile(delete=False) as g:
             self.cache_file = g.name
+        with tempfile.NamedTemporaryFile(delete=False) as g:
+            self.store_file = g.name
         pronunciation.CACHE_FILE = self.cache_file
+        pronunciation.STORE_FILE = self.store_file
 
     def tearDown(self):
         os.remove(self.cache_file)
+        os.remove(self.store_file)
 
     def test_query_edoc(self):
         s = '東方'
@@ -25,3 +36,227 @@ class TestPronunciation(unittest.TestCase):
         rets = pronunciation.get_pronunciation(s)
         for c in s:
             self.assertEqual(c, rets[c][0]['Graph'])
+
+
+class TestPronunciationStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        pronunciation.CACHE_FILE = os.path.join(self.tmp.name, 'prons.csv')
+        pronunciation.STORE_FILE = os.path.join(self.tmp.name, 'prons.db')
+        self.rows = [{'Graph': '長', 'GY Rhyme': '陽', 'GY Tone': '平'},
+                     {'Graph': '長', 'GY Rhyme': '養', 'GY Tone': '上'},
+                     {'Graph': '章', 'GY Rhyme': '陽', 'GY Tone': '平'}]
+        with open(pronunciation.CACHE_FILE, 'w', newline='') as g:
+            writer = csv.DictWriter(g, fieldnames=self.rows[0].keys())
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_import_csv(self):
+        self.assertEqual({'長': self.rows[:2], '章': self.rows[2:]},
+                         pronunciation.get_pronunciation())
+
+    def test_lookup(self):
+        self.assertEqual({'長': self.rows[:2]},
+                         pronunciation.lookup_pronunciations('長'))
+        self.assertEqual({}, pronunciation.lookup_pronunciations('東'))
+        self.assertEqual({'長': self.rows[:2], '章': self.rows[2:]},
+                         pronunciation.get_pronunciation('長章'))
+
+    def test_insert(self):
+        row = {'Graph': '東', 'GY Rhyme': '東', 'GY Tone': '平'}
+        pronunciation.insert_pronunciations([row])
+        self.assertEqual({'東': [row]},
+                         pronunciation.lookup_pronunciations('東'))
+        self.assertEqual(4, len(list(pronunciation.get_store().execute(
+            'SELECT * FROM pronunciation'))))
+
+    def test_views(self):
+        everything = pronunciation.get_pronunciation()
+        pronunciation.mark_unresolved('東')  # not queried
+        prons = pronunciation.get_pronunciation('長東')
+        self.assertIs(everything.readings, prons.readings)
+        self.assertEqual({'長', '東'}, set(prons))
+        self.assertEqual([], prons['東'])
+        self.assertNotIn('章', prons)
+        with self.assertRaises(KeyError):
+            prons['章']
+        with self.assertRaises(TypeError):
+            prons['章'] = self.rows[2:]
+
+        row = {'Graph': '東', 'GY Rhyme': '東', 'GY Tone': '平'}
+        pronunciation.insert_pronunciations([row])
+        self.assertEqual([row], everything['東'])
+        self.assertEqual([row], prons['東'])
+
+    def test_pickle_view(self):
+        prons = pickle.loads(pickle.dumps(
+            pronunciation.get_pronunciation('長')))
+        self.assertEqual({'長': self.rows[:2]}, prons.readings)
+
+    def test_finals(self):
+        rows = [{'Graph': '東', 'MCF': '-uŋ', 'GY Baxter': 'tuwng'},
+                {'Graph': '魚', 'MCF': '', 'GY Baxter': 'ngjo'},
+                {'Graph': '魚', 'MCF': '-+', 'GY Baxter': ''}]
+        with pronunciation.get_store() as conn:
+            conn.execute('DELETE FROM pronunciation')
+        pronunciation.insert_pronunciations(rows)
+        self.assertEqual({'東': ['-uŋ'], '魚': ['-jo', '-ɨ']},
+                         pronunciation.get_finals())
+        self.assertEqual(0, pronunciation.compute_finals())
+
+        # new readings invalidate the finals of their character
+        pronunciation.insert_pronunciations([{'Graph': '東', 'MCF': '',
+                                              'GY Baxter': 'yuwng'}])
+        self.assertEqual({'東': ['-uŋ', '-juwng']},
+                         pronunciation.get_finals('東'))
+
+    def test_extract_final_schuessler(self):
+        self.assertEqual('-jowng', pronunciation.extract_final_schuessler(
+            'tsjwoŋ'))
+        self.assertEqual('-jiek', pronunciation.extract_final_schuessler(
+            'jäk'))
+        self.assertEqual('-jun', pronunciation.extract_final_schuessler(
+            'tsjuoən'))
+        self.assertIsNone(pronunciation.extract_final_schuessler(''))
+
+
+class TestRhymeTable(unittest.TestCase):
+    def setUp(self):
+        self.prons = {'長': [{'GY Rhyme': '陽'}, {'GY Rhyme': '養'},
+                            {'GY Rhyme': '漾'}],
+                      '章': [{'GY Rhyme': '陽'}],
+                      '唐': [{'GY Rhyme': '唐'}],
+                      '䟽': [{'GY Rhyme': '魚'}],
+                      '東': [{'GY Rhyme': ''}]}
+        self.sbgy = {'陽': Rime('陽', '平', '陽'), '唐': Rime('唐', '平', '陽')}
+
+    def test_build_rhyme_table(self):
+        table = pronunciation.build_rhyme_table(self.prons)
+        for c in self.prons:
+            self.assertEqual(tuple(pronunciation.get_rhyme(c, self.prons)),
+                             table[c])
+        # 疎 => 疏 => 䟽
+        self.assertEqual(('魚',), table['疎'])
+        self.assertEqual((), table['東'])
+        table = pronunciation.build_rhyme_table({'章': self.prons['章'],
+                                                 '陽': self.prons['章']})
+        self.assertIs(table['章'], table['陽'])
+        with self.assertRaises(TypeError):
+            table['東'] = ('東',)
+
+    def test_tongyong(self):
+        table = pronunciation.build_rhyme_table(self.prons, self.sbgy)
+        self.assertEqual(('陽',), table['唐'])
+        self.assertEqual(('漾', '陽', '養'), table['長'])
+        self.assertIs(table['章'], table['唐'])
+
+    def test_get_rhyme_table(self):
+        table = pronunciation.get_rhyme_table(self.prons)
+        self.assertIs(table, pronunciation.get_rhyme_table(self.prons))
+        self.assertIsNot(table, pronunciation.get_rhyme_table(self.prons,
+                                                              self.sbgy))
+
+
+class TestEdocFetcher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.rows = load_rows()
+        cls.chars = ''.join(list(cls.rows)[:50])
+
+    def setUp(self):
+        self.original = (pronunciation.EDOC_URL, pronunciation.MAX_CHARS,
+                         pronunciation.BACKOFF, pronunciation.STORE_FILE,
+                         pronunciation.CACHE_FILE)
+        self.tmp = tempfile.TemporaryDirectory()
+        pronunciation.STORE_FILE = os.path.join(self.tmp.name, 'prons.db')
+        pronunciation.CACHE_FILE = os.path.join(self.tmp.name, 'prons.csv')
+        pronunciation.MAX_CHARS = 10
+        pronunciation.BACKOFF = 0.01
+
+    def tearDown(self):
+        (pronunciation.EDOC_URL, pronunciation.MAX_CHARS,
+         pronunciation.BACKOFF, pronunciation.STORE_FILE,
+         pronunciation.CACHE_FILE) = self.original
+        self.tmp.cleanup()
+
+    def expected(self, chars):
+        return [row for c in chars for row in self.rows[c]]
+
+    def test_query_edoc(self):
+        with EdocServer(self.rows) as server:
+            pronunciation.EDOC_URL = server.url
+            chunks = list()
+            ret = pronunciation.query_edoc(self.chars, on_chunk=chunks.append,
+                                           rate=100)
+        self.assertEqual(self.expected(self.chars), ret)
+        self.assertEqual(5, len(server.requests))
+        self.assertEqual(5, len(chunks))
+
+    def test_parse_result(self):
+        html = render_html(self.chars, self.rows)
+        self.assertEqual(self.expected(self.chars),
+                         pronunciation.parse_result(html))
+        self.assertEqual(pronunciation.parse_result_soup(html),
+                         pronunciation.parse_result(html))
+        with self.assertRaises(IndexError):
+            pronunciation.parse_result('<html><table></table></html>')
+
+    def test_retries(self):
+        with EdocServer(self.rows, failures=3) as server:
+            pronunciation.EDOC_URL = server.url
+            ret = pronunciation.query_edoc(self.chars, rate=100, retries=3)
+        self.assertEqual(self.expected(self.chars), ret)
+        self.assertEqual(8, len(server.requests))
+
+    def test_chunks_are_cached_as_they_arrive(self):
+        with EdocServer(self.rows, failures=2) as server:
+            pronunciation.EDOC_URL = server.url
+            with self.assertRaises(requests.HTTPError):
+                pronunciation.query_edoc(self.chars, rate=100, retries=0,
+                                         on_chunk=pronunciation
+                                         .insert_pronunciations)
+        # all the chunks but the two that failed made it to the store
+        self.assertEqual(30, len(pronunciation.lookup_pronunciations(
+            self.chars)))
+
+        with EdocServer(self.rows) as server:
+            pronunciation.EDOC_URL = server.url
+            prons = pronunciation.get_pronunciation(self.chars)
+        self.assertEqual(2, len(server.requests))  # only the missing chunks
+        self.assertEqual({c: self.rows[c] for c in self.chars}, prons)
+
+    def test_token_bucket(self):
+        bucket = pronunciation.TokenBucket(rate=50, capacity=2)
+        start = monotonic()
+        for _ in range(7):
+            bucket.acquire()
+        self.assertGreaterEqual(monotonic() - start, 5 / 50)
+
+    def test_unresolved_are_not_queried_again(self):
+        chars = self.chars[:5] + '\U000f0000'
+        with EdocServer(self.rows) as server:
+            pronunciation.EDOC_URL = server.url
+            prons = pronunciation.get_pronunciation(chars)
+            self.assertEqual([], prons['\U000f0000'])
+            prons = pronunciation.get_pronunciation(chars)
+            self.assertEqual(1, len(server.requests))
+
+            prons = pronunciation.get_pronunciation(chars, refresh=True)
+            self.assertEqual(['\U000f0000'], server.requests[1:])
+        self.assertEqual({c: self.rows[c] for c in chars}, prons)
+
+    def test_unresolved_expire(self):
+        original = pronunciation.NEGATIVE_TTL
+        self.addCleanup(setattr, pronunciation, 'NEGATIVE_TTL', original)
+        with EdocServer(self.rows) as server:
+            pronunciation.EDOC_URL = server.url
+            pronunciation.get_pronunciation('\U000f0000')
+            pronunciation.NEGATIVE_TTL = 0
+            pronunciation.get_pronunciation('\U000f0000')
+            pronunciation.NEGATIVE_TTL = original
+            pronunciation.forget_unresolved()
+            pronunciation.get_pronunciation('\U000f0000')
+        self.assertEqual(3, len(server.requests))
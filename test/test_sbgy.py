@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from ds import pronunciation, sbgy
+
+XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<book>
+<volume id="v1">
+<volume_title>宋本廣韻上平聲卷第一</volume_title>
+<catalog>
+<rhythmic_entry><fanqie>德紅</fanqie>東<note>獨用</note></rhythmic_entry>
+<rhythmic_entry><fanqie>都宗</fanqie>冬<note>鍾同用</note></rhythmic_entry>
+<rhythmic_entry><fanqie>職容</fanqie>鍾</rhythmic_entry>
+</catalog>
+<rhyme id="r1">
+<rhyme_num>一</rhyme_num>
+<voice_part id="v1">
+<word_head id="w1">東</word_head><note>春方也說文曰動也德紅切十七</note>
+<word_head id="w2">菄</word_head><note>東風菜</note>
+</voice_part>
+<voice_part id="v2">
+<word_head id="w3">同</word_head><note>齊也共也又姓徒紅切四十五</note>
+</voice_part>
+</rhyme>
+<rhyme id="r2">
+<rhyme_num>二</rhyme_num>
+<voice_part id="v3">
+<word_head id="w4">冬</word_head><note>四時之末都宗切十</note>
+</voice_part>
+</rhyme>
+<rhyme id="r3">
+<rhyme_num>三</rhyme_num>
+<voice_part id="v4">
+<word_head id="w5">鍾</word_head><note>酒器職容切又音同二十五</note>
+</voice_part>
+</rhyme>
+</volume>
+<volume id="v2">
+<volume_title>宋本廣韻上聲卷第三</volume_title>
+<catalog>
+<rhythmic_entry><fanqie>多動</fanqie>董<note>獨用</note></rhythmic_entry>
+</catalog>
+<rhyme id="r4">
+<rhyme_num>一</rhyme_num>
+<voice_part id="v5">
+<word_head id="w6">董</word_head><note>督也多動切七</note>
+<word_head id="w7">東</word_head><note>又音東</note>
+</voice_part>
+</rhyme>
+</volume>
+</book>
+'''
+
+
+class TestSbgy(unittest.TestCase):
+    def setUp(self):
+        self.original = sbgy.SBGY, sbgy.CACHE_DIR
+        self.tmp = tempfile.TemporaryDirectory()
+        sbgy.SBGY = os.path.join(self.tmp.name, 'sbgy.xml')
+        sbgy.CACHE_DIR = os.path.join(self.tmp.name, 'cache')
+        with open(sbgy.SBGY, 'w') as g:
+            g.write(XML)
+
+    def tearDown(self):
+        sbgy.SBGY, sbgy.CACHE_DIR = self.original
+        self.tmp.cleanup()
+
+    def test_load_sbgy(self):
+        rhymes = sbgy.load_sbgy()
+        self.assertEqual(sbgy.Rime('東', '平', None, True), rhymes['東'])
+        self.assertEqual(sbgy.Rime('鍾', '平', '冬', False), rhymes['鍾'])
+        self.assertEqual('上', rhymes['董'].tone)
+
+    def test_compiled_cache(self):
+        rhymes = sbgy.load_sbgy()
+        self.assertTrue(os.path.exists(sbgy.get_cache_path('rhymes')))
+        with unittest.mock.patch.object(sbgy, 'iter_rimes') as iter_rimes:
+            self.assertEqual(rhymes, sbgy.load_sbgy())
+            iter_rimes.assert_not_called()
+
+        # compiled again once the XML changes
+        with open(sbgy.SBGY, 'w') as g:
+            g.write(XML.replace('獨用', '冬同用', 1))
+        self.assertEqual('東', sbgy.load_sbgy()['冬'].eq)
+
+    def test_close_tongyong(self):
+        rhymes = ['支', '脂', '之', '微', '魚', '虞', '模']
+        # declared out of order, and through a chain
+        links = [('脂', '支'), ('之', '脂'), ('虞', '模'), ('魚', '虞')]
+        self.assertEqual({'脂': '支', '之': '支', '虞': '魚', '模': '魚'},
+                         sbgy.close_tongyong(rhymes, links))
+        self.assertEqual({}, sbgy.close_tongyong(rhymes, [('支', '東')]))
+
+    def test_tongyong_classes(self):
+        rhymes = sbgy.load_sbgy()
+        classes = sbgy.get_tongyong_classes(rhymes)
+        self.assertEqual(['東', '冬', '鍾', '董'], classes.rhymes)
+        self.assertEqual([0, 1, 1, 3], classes.classes.tolist())
+        self.assertEqual([1, 1, 0],
+                         sbgy.map_tongyong(classes, [2, 1, 0]).tolist())
+        self.assertEqual({'東': '東', '冬': '冬', '鍾': '冬', '董': '董'},
+                         sbgy.get_tongyong_map(rhymes))
+
+    def test_get_fanqie(self):
+        self.assertEqual('德紅', sbgy.get_fanqie('春方也德紅切十七'))
+        self.assertEqual('職容', sbgy.get_fanqie('酒器職容切又音同二十五'))
+        self.assertEqual('', sbgy.get_fanqie('東風菜'))
+
+    def test_load_sbgy_pronunciations(self):
+        prons = sbgy.load_sbgy_pronunciations()
+        self.assertEqual([{'Graph': '東', 'GY Rhyme': '東', 'GY Tone': '平',
+                           'GY fanqie': '德紅'},
+                          {'Graph': '東', 'GY Rhyme': '董', 'GY Tone': '上',
+                           'GY fanqie': '多動'}], prons['東'])
+        self.assertEqual('德紅', prons['菄'][0]['GY fanqie'])
+        self.assertEqual('徒紅', prons['同'][0]['GY fanqie'])
+        self.assertEqual('冬', prons['冬'][0]['GY Rhyme'])
+        self.assertEqual('鍾', prons['鍾'][0]['GY Rhyme'])
+
+    def test_offline_backend(self):
+        prons = pronunciation.get_pronunciation('東同龘', backend='sbgy')
+        self.assertEqual(['東', '董'], pronunciation.get_rhyme('東', prons))
+        self.assertEqual(['東'], pronunciation.get_rhyme('同', prons))
+        self.assertEqual([], prons['龘'])
+        with self.assertRaises(ValueError):
+            pronunciation.get_pronunciation('東', backend='nope')